@@ -2,3 +2,4 @@ from .data import *
 from .utils import *
 from .analysis import *
 from .visualization import *
+from .pipeline import *
@@ -0,0 +1,167 @@
+################################################################################
+# Module: Command line entry point
+# Runs ingest -> aggregate -> analyze -> render for a list of cities in parallel:
+#   python -m src --cities cdmx gdl --year-limit 2019 --month-limit 4
+# updated: 16/10/2026
+################################################################################
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib.pyplot as plt
+import src
+
+STEPS = ['ingest','aggregate','analyze','render']
+
+#functions that create data/raw/<city>/stack/ from the raw files of a city, cities without one use their stack as is
+INGEST = {'cdmx':src.rama_data, 'gdl':src.gdl_data}
+
+
+def _limit_memory(max_memory):
+    """Function used as initializer of the worker processes that limits the address space of each worker,
+        a city that needs more raises MemoryError instead of exhausting the memory of the machine
+
+    Args:
+        max_memory {int} -- limit in MB, None for no limit
+    """
+    if max_memory is None:
+        return
+
+    try:
+        import resource
+    except ImportError: #not available on windows
+        return
+
+    limit = max_memory*2**20
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _render(p, city):
+    #figures of every pollutant are closed so they are not drawn on the next one
+    try:
+        src.compare_aq(p, city)
+    finally:
+        plt.close('all')
+
+
+def run_city(city, year_limit=2020, month_limit=5, steps=STEPS):
+    """Function that runs the steps of the pipeline for a city, the stages pass their results in memory
+        and save their csv as they go
+
+    Args:
+        city {str} -- city code, one of the codes of city_name
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        month_limit {int} -- int with limit month to be analyzed, set to 5 (May) by default
+        steps {list} -- steps to be run, all by default
+
+    Returns:
+        dict -- dict with the seconds spent in every stage, the errors by stage, the stages skipped
+                and the result of data_valid
+    """
+    src.city_name(city) #unknown city codes fail before any step runs
+
+    timings = {}
+    errors = {}
+    skipped = []
+
+    def run(name, func, deps=(), **params):
+        #stages after a failed or skipped one are skipped, so they do not use the csv of a previous run
+        if any(d in errors or d in skipped for d in deps):
+            skipped.append(name)
+            return (None)
+
+        start = time.perf_counter()
+        try:
+            result = func(**params)
+        except Exception as e:
+            errors[name] = type(e).__name__+': '+str(e)
+            result = None
+        timings[name] = time.perf_counter() - start
+        return (result)
+
+    if 'ingest' in steps and city in INGEST:
+        run('ingest', INGEST[city])
+
+    merged, median, compare, valid = None, None, None, None
+
+    if 'aggregate' in steps:
+        merged = run('merge_aq', src.merge_aq, ['ingest'], city=city, year_limit=year_limit)
+        res = run('res_aqdata', src.res_aqdata, ['merge_aq'], city=city, year_limit=year_limit, data=merged)
+        median = run('aq_daily_median', src.aq_daily_median, ['res_aqdata'], city=city, year_limit=year_limit, data=res)
+
+    if 'analyze' in steps:
+        compare = run('aqip_city_mrg', src.aqip_city_mrg, ['aq_daily_median'], city=city, year_limit=year_limit,
+                      data=median)
+        valid = run('data_valid', src.data_valid, ['aqip_city_mrg'], city=city, data=compare)
+        run('airquality_average', src.airquality_average, ['merge_aq'], city=city, month_limit=month_limit,
+            year_limit=year_limit, data=merged)
+
+    if 'render' in steps:
+        for i in range(5):
+            run('compare_aq_'+src.pollutant(i), _render, ['aqip_city_mrg'], p=src.pollutant(i), city=city)
+
+    return ({'timings':timings, 'errors':errors, 'skipped':skipped, 'data_valid':valid})
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(prog='python -m src',
+                                     description='Runs ingest, aggregate, analyze and render for a list of cities')
+    parser.add_argument('--cities', nargs='+', default=list(INGEST), help='city codes, the cities with station data by default')
+    parser.add_argument('--year-limit', type=int, default=2020, help='last year analyzed, from 2017')
+    parser.add_argument('--month-limit', type=int, default=5, help='last month of every year analyzed')
+    parser.add_argument('--steps', nargs='+', default=STEPS, choices=STEPS, help='steps to be run, all by default')
+    parser.add_argument('--processes', type=int, default=None, help='cities run at the same time, one per core by default')
+    parser.add_argument('--max-memory', type=int, default=None, help='memory limit of every worker in MB')
+    parser.add_argument('--workdir', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'notebooks'),
+                        help='directory the ../data/ paths are relative to, notebooks/ by default')
+    args = parser.parse_args(args)
+
+    os.chdir(args.workdir)
+
+    results = {}
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=_limit_memory,
+                             initargs=(args.max_memory,)) as pool:
+
+        futures = {pool.submit(run_city, city, args.year_limit, args.month_limit, args.steps):city
+                   for city in dict.fromkeys(args.cities)}
+
+        for future in as_completed(futures):
+            city = futures[future]
+            try:
+                results[city] = future.result()
+            except Exception as e: #a failing city does not stop the others
+                results[city] = None
+                print(city+' failed: '+type(e).__name__+': '+str(e))
+                continue
+
+            for stage, error in results[city]['errors'].items():
+                print(city+' '+stage+' failed: '+error)
+            if len(results[city]['skipped']) > 0:
+                print(city+' skipped after a failed stage: '+', '.join(results[city]['skipped']))
+            print(city+' done' if len(results[city]['errors']) == 0 else city+' done with errors')
+
+    #summary of seconds by stage and city
+    timings = {city:result['timings'] for city, result in results.items() if result is not None}
+    stages = []
+    for t in timings.values():
+        stages += [s for s in t if s not in stages]
+
+    print('\n'+'stage'.ljust(24)+''.join(city.rjust(10) for city in timings))
+    for s in stages:
+        print(s.ljust(24)+''.join(('%.2f' % timings[city][s] if s in timings[city] else '-').rjust(10) for city in timings))
+    print('total'.ljust(24)+''.join(('%.2f' % sum(timings[city].values())).rjust(10) for city in timings))
+    print('wall time: %.2f s' % (time.perf_counter()-start))
+
+    for city, result in results.items():
+        if result is not None and result['data_valid'] is not None:
+            print(city+': '+result['data_valid'])
+
+    return (0 if all(result is not None and len(result['errors']) == 0 for result in results.values()) else 1)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -14,6 +14,7 @@ from scipy import stats
 import matplotlib.pyplot as plt
 import src
 from math import sqrt
+from functools import lru_cache
 import geopandas as gpd
 
 
@@ -35,51 +36,70 @@ def t_test(df_aqip, df_mx):
 
 
 
-def aqip_city_mrg(city):
+def aqip_city_mrg(city, year_limit=2020, data=None, aqip=None, save=True):
     """Function that creates a merged csv from dataframes from median concentrations 
         for air quality index project and mexican cities stations
 
     Args:
         city {str} -- code for the city that will be merged
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        data {Series} -- median by PARAM and FECHA as returned by aq_daily_median, if None the csv
+                         written by aq_daily_median is read, set to None by default
+        aqip {DataFrame} -- data from aqip for mexican cities, if None MX_2015 csv is read, set to None by default
+        save {bool} -- if False, the result is only returned and no csv is written, set to True by default
+
+    Returns:
+        DataFrame -- DataFrame with the aqip and stations median by pollutant and date
     """
 
     dir_pcs = '../data/processed/' #Directory for processed data
 
-    if not os.path.isdir(dir_pcs+'aqip_'+city): 
-        os.mkdir(dir_pcs+city) 
+    dir_pcs_cat = dir_pcs+'aqip_'+city+'/' #Directory to save concatenation
+
+    if data is None:
+        data = src.read_aq_csv(dir_pcs+city+'/'+'median_res_2017-'+str(year_limit)+'.csv', index_col=['PARAM','FECHA'])['0'] #csv with medians from city's air quality stations
 
-    dir_pcs_cat = dir_pcs+'aqip_'+city #Directory to save concatenation
+    if aqip is None:
+        aqip = src.read_aq_csv(src.AQIP_MX_CSV, index_col='City') #csv with medians from aqip database
 
-    mx = pd.read_csv(dir_pcs+city+'/'+'median_res_2017-2020.csv') #csv with medians from city's air quality stations
+    #both sources in one table filtered by city, so they share the codes of pollutants
+    table = src.AQTable.concat([src.aqip_to_long(aqip.loc[[src.aqip_city_name(city)]]),
+                                src.stack_to_long(data.to_frame('median'), 'stations', city)])
 
-    aqip = pd.read_csv(dir_pcs+'aqip/' +'MX_2015_2020.csv', index_col=[0]) #csv with medians from aqip database
+    #joins the medians of both sources by pollutant and date
+    compare = pd.concat({'aqip_median':table.series(source='AQIP'), 'mx_median':table.series(source='stations')},
+                        axis=1, join='inner')
 
-    aqip = aqip.loc[src.city_name(city)] #filters aqip data according to city
+    compare = compare.rename_axis(['Contaminante','Fecha']).reset_index()[['Contaminante','Fecha','aqip_median','mx_median']]
 
-    compare = pd.merge(aqip, mx, how='inner', left_on=['Specie','Date'], right_on=['PARAM','FECHA']) #merges csvs
+    if save:
+        os.makedirs(dir_pcs_cat, exist_ok=True)
 
-    compare = compare.drop(columns=['count','min','max','median','variance','PARAM','FECHA']).rename(columns={'Specie':'Contaminante',
-                                                                                                   'Date':'Fecha',
-                                                                                                   'c_median':'aqip_median',
-                                                                                                   '0':'mx_median'})
-    compare.to_csv(dir_pcs_cat +city+'_AQIP.csv') #saves merged csv
+        compare.to_csv(dir_pcs_cat +city+'_AQIP.csv') #saves merged csv
+
+    return (compare)
 
     
-def data_valid(city):
+def data_valid(city, data=None):
     """Function that compares if the air quality data from mexican monitoring stations and
         the air quality index project are statistically different
 
     Args:
         city {str} -- city code for the city to by analyzed
+        data {DataFrame} -- medians as returned by aqip_city_mrg, if None the csv written by aqip_city_mrg
+                            is read, set to None by default
 
     Return:
         str -- string with t and p values for the analyzed data
     """
 
     dir_pcs = '../data/processed/' #Directory for processed data
-    dir_pcs_cat = dir_pcs+'aqip_'+city #Directory to save concatenation
+    dir_pcs_cat = dir_pcs+'aqip_'+city+'/' #Directory to save concatenation
+
+    if data is None:
+        data = src.read_aq_csv(dir_pcs_cat +city+'_AQIP.csv') #DataFrame with medians from AQIP and air quality stations
 
-    valid_check = pd.read_csv(dir_pcs_cat +city+'_AQIP.csv') #DataFrame with medians from AQIP and air quality stations
+    valid_check = data
     
     df_aqip = valid_check[['Contaminante','aqip_median']] #DataFrame with aqip median
     df_mx = valid_check[['Contaminante','mx_median']] #Dataframe with city's air quality stations median
@@ -94,7 +114,192 @@ def data_valid(city):
 
         return ('For: '+src.pollutant(i)+' t value is: '+str(t)+' and p value is: '+str(p))
 
-def airquality_average(city, month_limit=5, year_limit=2020):
+class CoverageIndex:
+    """Presence of data by day for every (city or station, pollutant), stored as a boolean array of days x keys
+        together with its prefix sums, so the days with data within any window are counted in O(1)
+
+    Args:
+        start {str} -- first day of the index in format yyyy-mm-dd
+    """
+
+    def __init__(self, start):
+
+        self.start = pd.Timestamp(start).normalize()
+        self.keys = [] #(city or station, pollutant) of every column
+        self._key = {}
+
+        self.presence = np.zeros((0,0), dtype=bool)
+        self.prefix = np.zeros((1,0), dtype=np.int32) #days with data before each day
+
+    @classmethod
+    def from_long(cls, data, entity='City', pollutant='Specie', date='Date', value='c_median'):
+        """Creates an index from a DataFrame with a row by entity, pollutant and date, like MX_2015_2020.csv
+
+        Args:
+            data {DataFrame} -- DataFrame with data in long format
+            entity {str} -- column with the city or station, set to City by default
+            pollutant {str} -- column with the pollutant, set to Specie by default
+            date {str} -- column with the date, set to Date by default
+            value {str} -- column with the concentration, rows with nan are not counted, set to c_median by default
+
+        Returns:
+            CoverageIndex -- index with the days with data of the DataFrame
+        """
+        data = data.dropna(subset=[value])
+        dates = pd.to_datetime(data[date])
+
+        coverage = cls(dates.min())
+
+        for p, data_p in data.assign(**{date:dates}).groupby(pollutant, observed=True):
+            table = data_p.pivot_table(index=date, columns=entity, values=value, aggfunc='count', observed=True)
+            coverage.update(table, p)
+
+        return (coverage)
+
+    def _day(self, date):
+        return ((pd.Timestamp(date).normalize() - self.start).days)
+
+    def update(self, table, pollutant):
+        """Adds the days with data of a table to the index, only the prefix sums from the first day
+            of the table are calculated again
+
+        Args:
+            table {DataFrame} -- DataFrame with dates as index and one column per city or station, non null values are days with data
+            pollutant {str} -- pollutant of the table
+        """
+        days = np.array([self._day(d) for d in table.index], dtype=int)
+
+        if len(days) == 0:
+            return
+
+        if days.min() < 0:
+            raise ValueError('dates before the start of the index: '+str(self.start.date()))
+
+        #adds columns for new keys
+        new_keys = [(e, pollutant) for e in table.columns if (e, pollutant) not in self._key]
+        for k in new_keys:
+            self._key[k] = len(self.keys)
+            self.keys.append(k)
+
+        n_old = self.presence.shape[0]
+        n_days = max(n_old, days.max()+1)
+
+        #extends the array for new days and keys
+        if n_days > self.presence.shape[0] or len(new_keys) > 0:
+            presence = np.zeros((n_days, len(self.keys)), dtype=bool)
+            presence[:self.presence.shape[0], :self.presence.shape[1]] = self.presence
+            self.presence = presence
+
+        cols = np.array([self._key[(e, pollutant)] for e in table.columns], dtype=int)
+
+        self.presence[np.ix_(days, cols)] |= table.notna().to_numpy()
+
+        #prefix sums are recalculated from the first day updated or added
+        first = min(days.min(), n_old)
+        prefix = np.zeros((n_days+1, len(self.keys)), dtype=np.int32)
+        prefix[:first+1, :self.prefix.shape[1]] = self.prefix[:first+1]
+        prefix[first+1:] = prefix[first] + np.cumsum(self.presence[first:], axis=0, dtype=np.int32)
+        self.prefix = prefix
+
+    def count(self, pollutant, windows, entities=None):
+        """Counts the days with data of every city or station for a pollutant within one or more windows
+
+        Args:
+            pollutant {str} -- chemical formula of the pollutant
+            windows {list} -- list of (start, end) tuples with dates in format yyyy-mm-dd, both included
+            entities {list} -- cities or stations to be counted, all with the pollutant by default
+
+        Returns:
+            tuple -- Series with the days with data by city or station and int with the days in the windows
+        """
+        if entities is None:
+            entities = [e for e, p in self.keys if p == pollutant]
+
+        cols = np.array([self._key.get((e, pollutant), -1) for e in entities], dtype=int)
+
+        n = self.prefix.shape[0]-1
+        counts = np.zeros(len(cols), dtype=np.int64)
+        total = 0
+
+        for start, end in windows:
+            s, e = self._day(start), self._day(end)+1
+            total += max(e-s, 0)
+
+            #days outside of the index have no data
+            s, e = min(max(s, 0), n), min(max(e, 0), n)
+            counts += self.prefix[e, np.maximum(cols, 0)] - self.prefix[s, np.maximum(cols, 0)]
+
+        counts[cols < 0] = 0
+
+        return (pd.Series(counts, index=entities, name='Count'), total)
+
+    def pctg(self, pollutant, windows, entities=None):
+        """Calculates the fraction of days with data of every city or station for a pollutant within one or more windows
+
+        Args:
+            pollutant {str} -- chemical formula of the pollutant
+            windows {list} -- list of (start, end) tuples with dates in format yyyy-mm-dd, both included
+            entities {list} -- cities or stations, all with the pollutant by default
+
+        Returns:
+            Series -- fraction of days with data by city or station
+        """
+        counts, total = self.count(pollutant, windows, entities)
+
+        return ((counts/total).rename('Pctg'))
+
+    def valid(self, pollutant, windows, tresh=0.75):
+        """Returns the cities or stations with a fraction of days with data equal or greater than tresh
+
+        Args:
+            pollutant {str} -- chemical formula of the pollutant
+            windows {list} -- list of (start, end) tuples with dates in format yyyy-mm-dd, both included
+            tresh {float} -- treshold limit, set to 0.75 by default
+
+        Returns:
+            list -- list with city or station names
+        """
+        pctg = self.pctg(pollutant, windows)
+
+        return (pctg[pctg >= tresh].index.tolist())
+
+
+def aqip_windows(month_limit=5, year_limit=2020):
+    """Function that returns the windows from January to month_limit of every year from 2017 to year_limit,
+        the period used for the coverage in aqip_mx
+
+    Args:
+        month_limit {int} -- int with limit month to be analyzed, set to 5 (May) by default
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+
+    Returns:
+        list -- list of (start, end) tuples
+    """
+    return ([(pd.Timestamp(year,1,1), pd.Timestamp(year,month_limit,1) + pd.offsets.MonthEnd(0))
+             for year in range(2017,year_limit+1)])
+
+
+def aqip_coverage():
+    """Function that creates the coverage index for the criterion pollutants of the mexican cities in the AQIP database,
+        the index is shared by later calls and built again only when aqip_data rewrites the csv
+
+    Returns:
+        CoverageIndex -- index with the days with data by city and pollutant
+    """
+    return (_aqip_coverage(os.stat(src.AQIP_MX_CSV).st_mtime_ns))
+
+
+@lru_cache(maxsize=1)
+def _aqip_coverage(mtime):
+    #the modification time of the csv is the cache key, so a csv rewritten in the same process is read again
+    aqip_mx = src.read_aq_csv(src.AQIP_MX_CSV)
+
+    pollutants = [src.pollutant(i) for i in range(5)]
+
+    return (CoverageIndex.from_long(aqip_mx[aqip_mx['Specie'].isin(pollutants)]))
+
+
+def airquality_average(city, month_limit=5, year_limit=2020, data=None, save=True):
     """Function that creates separate csv from month 1 (january) to limit_month of the yearly data available, starting at 2017
         and ending at year_limit, set to default at 2020
 
@@ -102,35 +307,33 @@ def airquality_average(city, month_limit=5, year_limit=2020):
         city {str} -- string containing city code to be analyzed
         year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
         month_limit {int} -- int with limit month to be analyzed, set to 5 (May) by default
+        data {DataFrame} -- merged data indexed by PARAM and FECHA as returned by merge_aq, if None the csv
+                            written by merge_aq is read, set to None by default
+        save {bool} -- if False, the result is only returned and no csv is written, set to True by default
 
     Returns:
         csv: individual csv for each pollutant with the average data by week of the first four months of the yearly data available
+        dict -- dict with the DataFrame of each pollutant
     """
     dir_pcs_mx = '../data/processed/'+city+'/'  #Directory for processed data
 
     data_csv = dir_pcs_mx+city+'_2017-'+str(year_limit)+'.csv' #csv with pollutant data from city's air quality stations
     
-    #reads csv as dataframe and calculates daily averages pollutants concentrations
-    data_bydate = pd.read_csv(data_csv).set_index(['FECHA','PARAM']).groupby(level=('FECHA','PARAM')).mean().reset_index()
-    
-    data_bydate['FECHA'] = pd.to_datetime(data_bydate['FECHA']) #sets column as datetime
+    if data is None:
+        data = src.read_aq_csv(data_csv, index_col=['FECHA','PARAM'])
+
+    #calculates daily averages pollutants concentrations
+    data_bydate = data.groupby(level=('FECHA','PARAM'), observed=True).mean().reset_index()
     
     #creates a new dataframe with daily averages for the specified months
-    for m in range(1,month_limit+1):
-        if m == 1: 
-            filter_month=data_bydate[data_bydate['FECHA'].dt.month==m]
-
-        else:
-
-            month_tmp = data_bydate[data_bydate['FECHA'].dt.month==m]
-
-
-            filter_month = filter_month.append(month_tmp)
+    filter_month = pd.concat([data_bydate[data_bydate['FECHA'].dt.month==m] for m in range(1,month_limit+1)])
     
+    data_average = {}
+
     #creates csv for daily averages for each pollutant
     for i in range(5):
         
-        data_bydateParam = filter_month[filter_month['PARAM']==src.pollutant(i)].set_index('FECHA')
+        data_bydateParam = filter_month[filter_month['PARAM']==src.pollutant(i)].set_index('FECHA').drop(columns=['PARAM'])
         
         data_bydateParam = data_bydateParam.rolling(7, min_periods=1).mean()
         
@@ -138,9 +341,14 @@ def airquality_average(city, month_limit=5, year_limit=2020):
         if src.pollutant(i)!= 'PM10' or src.pollutant(i) != 'CO':
             data_bydateParam = data_bydateParam*1000
         
-        data_bydateParam.to_csv(data_csv[:-4]+'_'+src.pollutant(i)+'.csv')
+        if save:
+            data_bydateParam.to_csv(data_csv[:-4]+'_'+src.pollutant(i)+'.csv')
+
+        data_average[src.pollutant(i)] = data_bydateParam
+
+    return (data_average)
 
-def interpolate_tohex(city, pollutant, date, stations, city_area, cellsize, year_limit):
+def interpolate_tohex(city, pollutant, date, stations, city_area, cellsize, year_limit, dir_store=None, cube=None):
     """Function that creates a folium map with user specified city, pollutant and date and interpolates valid values
 
 
@@ -148,34 +356,46 @@ def interpolate_tohex(city, pollutant, date, stations, city_area, cellsize, year
             city {str} -- code for the city to be analyzed, for example: cdmx
             pollutant {str} -- pollutant to be plotted
             date {str} -- date to be analyzed in format yyyy-mm-dd
-            station {gdf} -- gdf with stations within the city
+            station {gdf} -- gdf with stations within the city, if None the shared station registry is used
             city_area {gdf} -- gdf with area of interpolation
             cell_size{float} -- cell size for the interpolation in degrees, set to 0.01 by default
             year_limit{int} -- int with the limit year for the city's database, set to 2020 by default
+            dir_store {str} -- if specified, the date is read from the parquet store in this directory
+                               instead of the processed csv, set to None by default
+            cube {AQCube} -- if specified, the date is read from the cube of the city instead of the processed csv,
+                             set to None by default
 
         Returns:
             gdf -- gdf with interpolated concentration for the specified pollutant
     """
 
     dir_pcs = '../data/processed/'    
-
-    data_csv = dir_pcs+city+'/'+city+'_2017-'+str(year_limit)+'_'+pollutant+'.csv'
-    
-    data_bydateParam = pd.read_csv(data_csv).set_index('FECHA')
-    
-    #lists to append valid values of lat and long for interpolation
     
-    x = []
-    y = []
+    #registry with the stations, the shared one is used unless a gdf with stations is passed
+    registry = src.station_registry() if stations is None else src.StationRegistry(stations)
+
+    est = registry.in_city(src.city_name(city)) #positions of the city's stations in the registry
+
+    if cube is not None:
+        c_values = cube.values(date, pollutant, registry.codigo[est])
+
+    else:
+        if dir_store is not None:
+            #reads only the row group with the date
+            data_bydateParam = src.read_parquet_store(city, pollutant, start=date, end=date, dir_store=dir_store)
+
+        else:
+            data_csv = dir_pcs+city+'/'+city+'_2017-'+str(year_limit)+'_'+pollutant+'.csv'
     
-    for i, est in stations[stations['city']==src.city_name(city)].iterrows():
-
-                est_code = stations.loc[(i),'codigo']
-                c_value = data_bydateParam.loc[(date),est_code]
-                
-                if pd.notna(c_value):
-                    x.append(est.long)
-                    y.append(est.lat)
+            data_bydateParam = pd.read_csv(data_csv).set_index('FECHA')
+
+        c_values = data_bydateParam.loc[(date),registry.codigo[est]].to_numpy(dtype=float)
+
+    #saves coordinates and values of stations with air quality data
+    valid = ~np.isnan(c_values)
+    x = registry.long[est][valid]
+    y = registry.lat[est][valid]
+    c_values = c_values[valid]
     
     #Registers the boundries coordinates for the interpolation
     min_x, min_y, max_x, max_y = city_area.geometry.total_bounds
@@ -195,14 +415,9 @@ def interpolate_tohex(city, pollutant, date, stations, city_area, cellsize, year
     #interpolates the data
     while xidw <= max_x:
         while yidw <= max_y:
-            for i, est in stations[stations['city']==src.city_name(city)].iterrows():
-
-                est_code = stations.loc[(i),'codigo']
-                c_value = data_bydateParam.loc[(date),est_code]
-
-                if pd.notna(c_value):
-                    dividendo = (c_value/(sqrt((est.long-xidw)**2+(est.lat-yidw)**2)**(p)))+ dividendo
-                    divisor = (1/(sqrt((est.long-xidw)**2+(est.lat-yidw)**2)**(p))) + divisor
+            dist = np.sqrt((x-xidw)**2+(y-yidw)**2)**(p)
+            dividendo = (c_values/dist).sum()
+            divisor = (1/dist).sum()
 
             concentracion = dividendo/divisor
 
@@ -14,425 +14,2012 @@ import numpy as np
 from scipy import stats
 import matplotlib.pyplot as plt
 import xlrd
+import re
+import shutil
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 import src
 
+_JSON_SEP = re.compile(r'[\s,]*') #whitespace and commas between records of a json array
 
-def parse_mediciones_json(json_file):
+#columns of a SINAICA record kept when records from different files are consolidated
+MEDICIONES_COLS = ['id','estacionesid','city','state','parametro','fecha','hora','date','valororig','validoorig']
+
+#schema applied by read_aq_csv: columns read as categories, columns read as dates, every other column is float32
+AQ_CATEGORIES = ['PARAM','Specie','City','Contaminante','Country','city','state','codigo','nombre']
+AQ_DATES = ['FECHA','Date','Fecha']
+AQ_DATE_FORMAT = '%Y-%m-%d'
+
+#csv written by aqip_data with the AQIP data of every mexican city, read by every stage that compares with AQIP
+AQIP_MX_CSV = '../data/processed/aqip/MX_2015_2020.csv'
+
+#columns of the AQIP rows kept by aqip_data, the numeric ones are read as float32
+AQIP_COLS = ['Date','City','Specie','count','min','max','median','variance']
+
+
+def _iter_json_results(json_file, key='results', bufsize=2**16):
+    """Generator that reads the records of a json array incrementally, without loading the whole file
+
+    Args:
+        json_file {str} -- path to json file
+        key {str} -- key of the array with the records, set to 'results' by default
+        bufsize {int} -- number of characters read from the file at a time, set to 65536 by default
+
+    Yields:
+        dict -- record from the array
+    """
+    decoder = json.JSONDecoder()
+    token = '"'+key+'"'
+
+    with open (json_file,'r') as aux:
+
+        buf = ''
+
+        #reads until the opening bracket of the array is found
+        while True:
+            chunk = aux.read(bufsize)
+            buf += chunk
+            pos = buf.find(token)
+
+            if pos >= 0:
+                start = buf.find('[', pos+len(token))
+                if start >= 0:
+                    buf = buf[start+1:]
+                    break
+
+            elif chunk:
+                buf = buf[-len(token):] #keeps the tail in case the key was split between reads
+
+            if not chunk:
+                return
+
+        idx = 0
+        eof = False
+
+        #decodes one record at a time and only reads more text when a record is incomplete
+        while True:
+            idx = _JSON_SEP.match(buf, idx).end()
+
+            if idx < len(buf) and buf[idx] == ']':
+                return
+
+            try:
+                record, idx = decoder.raw_decode(buf, idx)
+
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = aux.read(bufsize)
+                eof = not chunk
+                buf = buf[idx:] + chunk #drops the records already decoded
+                idx = 0
+                continue
+
+            yield record
+
+
+def _iter_jsonl_records(jsonl_file):
+    """Generator that reads the records of a json lines file, one record per line
+
+    Args:
+        jsonl_file {str} -- path to jsonl file
+
+    Yields:
+        dict -- record from the file
+    """
+    with open (jsonl_file,'r') as aux:
+        for line in aux:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_mediciones_json(json_file, chunksize=100000):
+    """Function that reads a SINAICA json file in chunks, records are gathered in columnar buffers so
+        the memory used depends on chunksize and not on the size of the file
+
+    Args:
+        json_file {str} -- path to json file with a 'results' array, or to a jsonl file with a record per line
+        chunksize {int} -- number of records per DataFrame, set to 100000 by default
+
+    Yields:
+        DataFrame -- DataFrame with up to chunksize records
+    """
+    cols = {} #dictionary with a list of values for each key in the records
+    n = 0
+
+    if json_file.endswith('.jsonl'):
+        records = _iter_jsonl_records(json_file)
+    else:
+        records = _iter_json_results(json_file)
+
+    for r in records:
+
+        #adds keys not seen in previous records and fills them for the rows already gathered
+        for k in r:
+            if k not in cols:
+                cols[k] = [None]*n
+
+        for k, col in cols.items():
+            col.append(r.get(k))
+
+        n += 1
+
+        if n == chunksize:
+            yield pd.DataFrame(cols)
+            cols = {k:[] for k in cols}
+            n = 0
+
+    if n > 0:
+        yield pd.DataFrame(cols)
+
+
+def mediciones_json_to_csv(json_file, csv_file, chunksize=100000, columns=None):
+    """Function that writes a SINAICA json file to csv one chunk at a time
+
+    Args:
+        json_file {str} -- path to json file with a 'results' array
+        csv_file {str} -- path to the csv file to be written
+        chunksize {int} -- number of records written at a time, set to 100000 by default
+        columns {list} -- if specified, columns written in every chunk, for example MEDICIONES_COLS, by default
+                          every key found in the records is written
+
+    Returns:
+        int -- number of records written
+    """
+    total = 0
+    header = None
+    union = list(columns) if columns is not None else []
+
+    for chunk in iter_mediciones_json(json_file, chunksize=chunksize):
+
+        #keys that first appear in this chunk are added after the previous ones
+        if columns is None:
+            union += [col for col in chunk.columns if col not in union]
+
+        if header is None:
+            header = list(union)
+            chunk.reindex(columns=header).to_csv(csv_file, index=False)
+
+        else:
+            #rows are written with every key known so far, the header is completed at the end
+            chunk.reindex(columns=union).to_csv(csv_file, mode='a', index=False, header=False)
+
+        total += len(chunk)
+
+    #rewrites the csv with the header of every key when keys appeared after the first chunk,
+    #shorter rows of earlier chunks are filled with empty cells
+    if header is not None and len(union) > len(header):
+
+        with open (csv_file+'.tmp','w') as outfile:
+            for n, chunk in enumerate(pd.read_csv(csv_file, names=union, skiprows=1, dtype=str, chunksize=chunksize)):
+                chunk.to_csv(outfile, index=False, header=(n == 0))
+
+        os.replace(csv_file+'.tmp', csv_file)
+
+    return (total)
+
+
+def parse_mediciones_json(json_file, chunksize=None):
     """Function that converts json files to csv, function from: https://datos.gob.mx/blog/ventilando-datos-abiertos-sobre-calidad-del-aire
 
     Args:
         json_file {json} -- file in json
+        chunksize {int} -- if specified, returns a generator of DataFrames with chunksize records instead
+                            of a single DataFrame, set to None by default
 
     Returns:
-        csv -- json convedescriptionrted to csv
+        DataFrame -- json converted to DataFrame, or generator of DataFrames when chunksize is specified
     """
-    
-    with open (json_file,'r') as aux:
-        results = json.load(aux)['results']
-        
-    pre_data=[]
 
-    for r in results:
-        
-        aux = pd.DataFrame.from_dict(r,orient='index').T
-        pre_data.append(aux)
+    if chunksize is not None:
+        return (iter_mediciones_json(json_file, chunksize=chunksize))
+
+    pre_data = list(iter_mediciones_json(json_file))
     
     if len(pre_data)>0:
         pre_data = pd.concat(pre_data,ignore_index=True)
         return (pre_data)
 
 
-def data_sinaica(city, num_datos):
-    """Function that downloads csv with from SINAICA for a given city
+def _normalize_mediciones(data):
+    """Function that sets the columns and types of a DataFrame of SINAICA records to a fixed layout
 
     Args:
-        city {str} -- code for city to be downloaded
-
-    Return
-        csv  -- csv with air quality data for the specified city from the SINAICA database
+        data {DataFrame} -- DataFrame with SINAICA records
 
+    Returns:
+        DataFrame -- DataFrame with the columns in MEDICIONES_COLS
     """
-    dir_raw = '../data/raw/' #dictionary for raw data
+    data = data.reindex(columns=MEDICIONES_COLS)
 
-    #checks if directory exists and creates it if it doesn't
-    if not os.path.isdir(dir_raw+city): 
-        os.mkdir(dir_raw+city) 
-        for i in range(5): os.mkdir(dir_raw+city+'/'+src.pollutant(i))
+    #numeric columns are coerced so files with missing or text values share the same types
+    for col in ['estacionesid','hora','valororig','validoorig']:
+        data[col] = pd.to_numeric(data[col], errors='coerce')
 
+    return (data)
 
-    #calls pollutant functions and gathers data for the specified city and pollutant
-    for i in range(5):
-        filename = city+'_'+src.pollutant(i)
-        filename = dir_raw+city+'/'+src.pollutant(i)+'/'+filename
-        
-        #calls datosgobmx and gets data in json
-        data_api = client.makeCall('sinaica',{'pageSize':num_datos, 'city':src.city_name(city), 'parametro':src.pollutant(i)})
-            
-        with open (filename,'w') as outfile:
-            json.dump(data_api,outfile)
-            
-        sinaica_mediciones = parse_mediciones_json(filename)
 
-        sinaica_mediciones.to_csv(filename+'.csv', index=False) #writes csv file from json
+def _ingest_json_file(json_file, csv_file, chunksize):
+    """Function used by ingest_json_dir to write the normalized records of one json file to a csv without header
 
-def stations_csv():
-    """Function that downloads csv with information for all Mexican air quality stations using SINAICA api
+    Args:
+        json_file {str} -- path to json file
+        csv_file {str} -- path to the partial csv
+        chunksize {int} -- number of records read at a time
 
     Returns:
-        csv -- csv with information for all air quality stations from the SINAICA database
+        int -- number of records written
+    """
+    total = 0
+
+    with open (csv_file,'w') as outfile:
+        for chunk in iter_mediciones_json(json_file, chunksize=chunksize):
+            _normalize_mediciones(chunk).to_csv(outfile, index=False, header=False)
+            total += len(chunk)
+
+    return (total)
+
 
+def ingest_json_dir(dirs=('../data/raw/json/','../data/raw/'), output='../data/processed/sinaica/sinaica_mediciones.csv',
+                    processes=None, chunksize=100000):
+    """Function that parses every SINAICA json or jsonl file in one or more directories in a process pool and writes
+        the normalized records to a single csv. Files without a 'results' array are skipped
+
+    Args:
+        dirs {str or list} -- directories with json files, subdirectories are not read,
+                              set to data/raw/json/ and data/raw/ by default
+        output {str} -- path of the consolidated csv
+        processes {int} -- number of worker processes, set to the number of cores by default
+        chunksize {int} -- number of records read at a time by each worker, set to 100000 by default
+
+    Returns:
+        dict -- number of files, records, seconds and records per second of the ingestion
     """
-        
-    parametros_request = client.makeCall('sinaica-estaciones',{'pageSize':200}) #calls datosgobmx function and gathers data
-    dir_raw_grl = '../data/raw/Grl/'
+    if isinstance(dirs, str):
+        dirs = [dirs]
 
-    stations = [] #list which saves station information
+    #gathers json files of every directory
+    files = []
+    for d in dirs:
+        for file in sorted(os.listdir(d)):
+            if file.endswith(('.json','.jsonl')) and os.path.isfile(os.path.join(d,file)):
+                files.append(os.path.join(d,file))
 
-    #gathers data from all stations and interates over them
-    for v in parametros_request['results']:
-        aux = pd.DataFrame.from_dict(v,orient='index').T
-        stations.append(aux)
+    out_dir = os.path.dirname(output)
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
 
-    stations = pd.concat(stations, ignore_index=True)
+    parts = [output+'.part'+str(n) for n in range(len(files))]
 
-    #Removes stations that are out of Mexico
-    mask = (stations.lat.between(14, 34.5)) & (stations.long.between(-120, -70))
-    stations = stations[mask]
+    start = time.perf_counter()
 
-    filename = dir_raw_grl+'estaciones'
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        counts = list(pool.map(_ingest_json_file, files, parts, [chunksize]*len(files)))
 
-    stations.to_csv (r''+filename+'.csv', index = False, header=True) #saves to csv
+    #concatenates partial csv in file order below a single header
+    with open (output,'w') as outfile:
+        outfile.write(','.join(MEDICIONES_COLS)+'\n')
+        for part in parts:
+            with open (part,'r') as aux:
+                shutil.copyfileobj(aux, outfile)
+            os.remove(part)
 
+    elapsed = time.perf_counter() - start
+    records = sum(counts)
 
-def merge_aq(city, year_limit=2020):
-    """Function that merges the databases from air quality stations for a given city 
-        into a single csv from a period starting at 2017 and ending at year_limit, set to default at 2020
+    stats_ingest = {'files':len(files), 'records':records, 'seconds':elapsed,
+                    'records_per_second':records/elapsed if elapsed > 0 else float('nan')}
+
+    print('Ingested '+str(records)+' records from '+str(len(files))+' files in '+
+          '{:.2f}'.format(elapsed)+' s ('+'{:.0f}'.format(stats_ingest['records_per_second'])+' records/s)')
+
+    return (stats_ingest)
+
+
+def _evict_cache(cache_dir, max_bytes):
+    """Function that removes the least recently used responses until the cache is smaller than max_bytes
 
     Args:
-        city {str} -- string containing city code to be analyzed
-        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        cache_dir {str} -- directory of the response cache
+        max_bytes {int} -- maximum size of the cache in bytes
+    """
+    entries = []
+    for file in os.listdir(cache_dir):
+        if file.endswith('.json'):
+            st = os.stat(os.path.join(cache_dir,file))
+            entries.append((st.st_atime, st.st_size, file))
+
+    total = sum(e[1] for e in entries)
+
+    for atime, size, file in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir,file))
+        except FileNotFoundError:
+            pass #removed by another process
+        total -= size
+
+
+def cached_call(endpoint, params, ttl=86400, cache_dir='../data/interim/cache/', max_bytes=2**30, fetch=None):
+    """Function that calls the datosgobmx api through an on-disk cache. Responses are saved in a file named
+        after the hash of the endpoint and parameters and reused while they are younger than ttl
+
+    Args:
+        endpoint {str} -- api endpoint, for example: sinaica-estaciones
+        params {dict} -- parameters of the call
+        ttl {float} -- seconds a cached response is valid, set to 86400 (one day) by default
+        cache_dir {str} -- directory of the response cache, set to data/interim/cache/ by default
+        max_bytes {int} -- maximum size of the cache, least recently used responses are removed first,
+                           set to 1 GB by default
+        fetch {callable} -- function with the signature of client.makeCall(endpoint, params) used on a miss,
+                            set to client.makeCall by default
 
     Returns:
-        csv -- csv with all the data from air quality stations
+        dict -- api response
     """
+    if fetch is None:
+        fetch = client.makeCall
 
-    dir_raw = '../data/raw/'
-    dir_pcs = '../data/processed/'
-    
-    all_data = pd.DataFrame() #DataFrame that will contain all data
+    key = hashlib.sha256(json.dumps([endpoint, params], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, key+'.json')
 
-    for year in range(2017,year_limit+1):
-        
-        #for i in range(5):
-            #for statement used in cdmx   
-            #data = pd.read_excel(dir_raw+city+str(year)[-2:]+'RAMA\\'+str(year)+strc.pollutant(i)+'.xls').replace(-99,np.NaN)
-        
-        #access air quality data for a specified year
-        data = pd.read_csv(dir_raw+city+'/stack/'+str(year)+'.csv').replace(r'^\s*$',np.nan,regex=True)
-        data = data.set_index(['PARAM','FECHA'])
-        all_data = all_data.append(data)
-    
-    filename = dir_pcs + city + '/' + city + '_' + str(2017)+'-'+str(year_limit)
+    now = time.time()
 
-    all_data.to_csv (r''+filename+'.csv', index = True, header=True) #saves DataFrame to csv
+    try:
+        mtime = os.path.getmtime(path)
 
-def res_aqdata(city, year_limit=2020):
-    """Function that groups data from air quality stations by date and parameter for every station from 
-        a period starting at 2017 and ending at year_limit, set to default at 2020
+        if now - mtime < ttl:
+            with open (path,'r') as aux:
+                response = json.load(aux)
+
+            os.utime(path, (now, mtime)) #access time marks the use for eviction, mtime keeps the age for ttl
+            return (response)
+
+    except (FileNotFoundError, ValueError):
+        pass #missing or incomplete entry, downloaded again
+
+    response = fetch(endpoint, params)
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    #writes to a temporary file first so readers never see an incomplete response, the name is unique
+    #so threads of the same process writing the same key do not share it
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen (fd,'w') as outfile:
+        json.dump(response,outfile)
+    os.replace(tmp, path)
+
+    _evict_cache(cache_dir, max_bytes)
+
+    return (response)
+
+
+def _call_with_retry(fetch, endpoint, params, retries=3, backoff=1.0):
+    """Function that calls an api and retries with exponential backoff when the call fails
 
     Args:
-        city {str} -- string containing city code to be analyzed
-        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        fetch {callable} -- function with the signature of client.makeCall(endpoint, params)
+        endpoint {str} -- api endpoint, for example: sinaica
+        params {dict} -- parameters of the call
+        retries {int} -- number of retries after the first failed call, set to 3 by default
+        backoff {float} -- seconds waited before the first retry, doubled on every retry, set to 1.0 by default
 
     Returns:
-        csv -- csv with sumarized data
+        dict -- api response
     """
+    for attempt in range(retries+1):
+        try:
+            return (fetch(endpoint, params))
 
-    dir_pcs = '../data/processed/' #directory for processed data
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff*2**attempt)
 
-    res_data = pd.read_csv(dir_pcs +city + str(2017)+'-'+str(year_limit)+'.csv', index_col = [0,1]) 
 
-    res_data = res_data.groupby(['PARAM','FECHA']).mean() #calculates mean for pollutant and date
-    
-    filename = dir_pcs +'res_'+ str(2017)+'-'+str(year_limit)
+def _write_state(state_file, state):
+    """Function that replaces a json state file atomically so an interrupted write never leaves it incomplete
 
-    res_data.to_csv (r''+filename+'.csv', index = True, header=True) #saves csv
-    
-    
-def aq_daily_median(city, year_limit=2020):
-    """Function that calculates the median by day for a given city and pollutant from 
-        a period starting at 2017 and ending at year_limit, set to default at 2020
+    Args:
+        state_file {str} -- path to the state file
+        state {dict} -- state to be saved
+    """
+    with open (state_file+'.tmp','w') as outfile:
+        json.dump(state,outfile)
+
+    os.replace(state_file+'.tmp', state_file)
+
+
+def _sinaica_pages(filename, params, num_datos, page_size, fetch, retries, backoff):
+    """Function that downloads SINAICA records page by page, appending every page to a jsonl file and its
+        parsed records to a csv. After each page a checkpoint is saved, so when a page fails after its
+        retries a new call with the same params, num_datos and page_size continues from that page without
+        downloading the previous ones again, a call with other values starts from the first page
 
     Args:
-        city {str} -- city code to calculate median
-        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        filename {str} -- path without extension for the jsonl, csv and checkpoint files
+        params {dict} -- parameters of the call, without page and pageSize
+        num_datos {int} -- number of records requested, if None pages are requested until a page is incomplete
+        page_size {int} -- number of records per page
+        fetch {callable} -- function with the signature of client.makeCall(endpoint, params)
+        retries {int} -- number of retries for a failed page
+        backoff {float} -- seconds waited before the first retry
 
     Returns:
-        csv -- csv for the date and calculated median
+        int -- number of records downloaded
     """
+    jsonl_file = filename+'.jsonl'
+    csv_file = filename+'.csv'
+    state_file = filename+'.state'
 
-    dir_pcs = '../data/proccessed/'
+    #a checkpoint is only resumed by a call with the same query, page numbers of another query point to other records
+    query = {'params':hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest(),
+             'page_size':page_size, 'num_datos':num_datos}
 
-    aq_median_data = pd.read_csv(dir_pcs +city+'res_'+ str(2017)+'-'+str(year_limit)+'.csv', index_col = [0,1]).median(axis=1)
-    
-    aq_median_data.to_csv(dir_pcs+city+'median_res_'+ str(2017)+'-'+str(year_limit)+'.csv')
+    state = None
 
+    if os.path.isfile(state_file):
+        with open (state_file,'r') as aux:
+            state = json.load(aux)
 
-def aqip_data():
-    """Function that extracts data for mexican city from the Air Quality Index Project database.
+        #outputs deleted or shorter than the checkpoint cannot be resumed, the download starts again
+        if not all(os.path.isfile(f) and os.path.getsize(f) >= state[k] for f, k in [(jsonl_file,'jsonl'), (csv_file,'csv')]):
+            state = None
 
-    Returns:
-        csv -- csv with AQIP data for mexican cities
+        elif state.get('query') != query:
+            print('Checkpoint of '+filename+' belongs to another query, the download starts again')
+            state = None
+
+    if state is not None:
+        #removes anything written after the last checkpoint
+        for f, k in [(jsonl_file,'jsonl'), (csv_file,'csv')]:
+            with open (f,'r+') as aux:
+                aux.truncate(state[k])
+
+    else:
+        open(jsonl_file,'w').close()
+
+        with open (csv_file,'w') as outfile:
+            outfile.write(','.join(MEDICIONES_COLS)+'\n')
+
+        state = {'page':0, 'records':0, 'jsonl':os.path.getsize(jsonl_file), 'csv':os.path.getsize(csv_file),
+                 'query':query}
+        _write_state(state_file, state)
+
+    while num_datos is None or state['records'] < num_datos:
+
+        page = state['page']+1
+
+        data_api = _call_with_retry(fetch, 'sinaica', dict(params, page=page, pageSize=page_size),
+                                    retries=retries, backoff=backoff)
+
+        results = data_api.get('results', [])
+
+        if num_datos is not None:
+            results = results[:num_datos-state['records']]
 
+        if len(results) > 0:
+
+            with open (jsonl_file,'a') as outfile:
+                outfile.write(''.join(json.dumps(r)+'\n' for r in results))
+                state['jsonl'] = outfile.tell()
+
+            #parses the page as it arrives
+            with open (csv_file,'a') as outfile:
+                _normalize_mediciones(pd.DataFrame(results)).to_csv(outfile, index=False, header=False)
+                state['csv'] = outfile.tell()
+
+        state['page'] = page
+        state['records'] += len(results)
+        _write_state(state_file, state)
+
+        if len(results) < page_size:
+            break
+
+    os.remove(state_file) #the download finished, a new call starts from the first page
+
+    return (state['records'])
+
+
+def _sinaica_pollutant(city, p, num_datos, fetch, retries, backoff, page_size=None):
+    """Function used by data_sinaica_mx that downloads and writes data for a single city and pollutant
+
+    Args:
+        city {str} -- code for city to be downloaded
+        p {str} -- chemical formula of the pollutant
+        num_datos {int} -- number of records requested
+        fetch {callable} -- function with the signature of client.makeCall(endpoint, params)
+        retries {int} -- number of retries for a failed call
+        backoff {float} -- seconds waited before the first retry
+        page_size {int} -- if specified, records are downloaded in pages of page_size to a jsonl file
+
+    Returns:
+        str -- path of the json or jsonl file written
     """
-    dir_raw_aqip = '../data/raw/AirQualityIndexProject/world_data/'
-    dir_pcs_aqip = '../data/processed/aqip/'
-    
-    all_data = pd.DataFrame()
+    dir_raw = '../data/raw/' #directory for raw data
 
-   #reads all csv files from specified directory 
-    for file in os.listdir(dir_raw_aqip):
+    filename = dir_raw+city+'/'+p+'/'+city+'_'+p
 
-        filename = dir_raw_aqip + file
-        
-        data_aqip = pd.DataFrame()
-        
-        data_aqip = pd.read_csv(filename, skiprows=4)
-        
-        data_aqip['Specie'] = data_aqip['Specie'].str.upper() #changes pollutants to capital letters
-        
-        data_aqip = data_aqip.set_index(['Specie'])
-        
-        data_aqip = data_aqip[data_aqip['Country']=='MX'].drop(['Country'], axis=1) #filters for Mexico
-        
-        all_data = all_data.append(data_aqip)
-        
-    #Condition that selects pollutant
-    cond = [all_data.index == 'O3', all_data.index == 'CO', all_data.index == 'PM10', 
-           all_data.index == 'PM25', all_data.index == 'NO2', all_data.index == 'SO2']
-    
-    #Choice that dictates what happends for each case
-    choice = [all_data['median'].apply(src.o3_conc), all_data['median'].apply(src.co_conc), 
-             all_data['median'].apply(src.pm10_conc), all_data['median'].apply(src.pm25_conc),
-             all_data['median'].apply(src.no2_conc), all_data['median'].apply(src.so2_conc)]
-    
-    #Calculates a new column with the data converted from 
-    #air quality index to concentration by pollutant
+    if page_size is not None:
+        _sinaica_pages(filename, {'city':src.city_name(city), 'parametro':p}, num_datos, page_size,
+                       fetch, retries, backoff)
+        return (filename+'.jsonl')
 
-    all_data['c_median'] = np.select(cond, choice)
-    
-    all_data = all_data.reset_index().set_index(['City','Specie','Date'])
+    #calls datosgobmx and gets data in json
+    data_api = _call_with_retry(fetch, 'sinaica', {'pageSize':num_datos, 'city':src.city_name(city), 'parametro':p},
+                                retries=retries, backoff=backoff)
 
-    all_data.to_csv(dir_pcs_aqip +'MX_2015_2020.csv')
-    
-    
-def gdl_data ():
-    """Function that merges and adjusts format for SIMAJ database for Guadalajara's stations
+    with open (filename,'w') as outfile:
+        json.dump(data_api,outfile)
+
+    #writes csv file from json in chunks, with the same columns as the paged download
+    with open (filename+'.csv','w') as outfile:
+        outfile.write(','.join(MEDICIONES_COLS)+'\n')
+        for chunk in iter_mediciones_json(filename):
+            _normalize_mediciones(chunk).to_csv(outfile, index=False, header=False)
+
+    return (filename)
+
+
+def data_sinaica_mx(cities, num_datos, workers=5, retries=3, backoff=1.0, fetch=None, page_size=None):
+    """Function that downloads csv from SINAICA for several cities, every city and pollutant request
+        runs concurrently in a thread pool
+
+    Args:
+        cities {list} -- list with codes for cities to be downloaded
+        num_datos {int} -- number of records requested for every city and pollutant
+        workers {int} -- maximum number of concurrent requests, set to 5 by default
+        retries {int} -- number of retries for a failed request, set to 3 by default
+        backoff {float} -- seconds waited before the first retry, doubled on every retry, set to 1.0 by default
+        fetch {callable} -- function with the signature of client.makeCall(endpoint, params) used for the requests,
+                            set to cached_call by default
+        page_size {int} -- if specified, records are requested in pages of page_size and streamed to a jsonl file,
+                           a failed download continues from the last page saved, set to None by default
 
     Returns:
-        csv -- 
-    
+        list -- paths of the json or jsonl files written
     """
+    dir_raw = '../data/raw/' #directory for raw data
 
-    dir_gdl = '../data/raw/gdl/'
-    
-    #dictionary for stations codes and names
-    est_dict = {'ÁGUILAS':'AGU', 'ATEMAJAC':'ATM', 'CENTRO':'CEN', 
-                'LAS PINTAS':'PIN', 'LOMA DORADA':'LDO', 'MIRAVALLE':'MIR', 'OBLATOS':'OBL', 
-                'SANTA FE':'SFE', 'TLAQUEPAQUE':'TLA', 'VALLARTA':'VAL'} 
-    
-    #check for file or directory in dir_gdl
-    for file in os.listdir(dir_gdl):
+    if fetch is None:
+        fetch = cached_call
 
-        f_check = os.path.join(dir_gdl,file)
+    #checks if directories exist and creates them if they don't
+    for city in cities:
+        for i in range(5):
+            os.makedirs(dir_raw+city+'/'+src.pollutant(i), exist_ok=True)
 
-        if os.path.isfile(f_check):
-            #SIMAJ data is in xls and in different sheets
-            xls = xlrd.open_workbook(r''+dir_gdl+file, on_demand=True)
-            sheets = xls.sheet_names() #creates list form sheet names
+    with ThreadPoolExecutor(max_workers=workers) as pool:
 
-        else:
-            continue
-        
-        year = file[6:10] #gathers the year from the file name
+        futures = [pool.submit(_sinaica_pollutant, city, src.pollutant(i), num_datos, fetch, retries, backoff, page_size)
+                   for city in cities for i in range(5)]
 
-        #creates DataFrame to save pollutant information
-        df = pd.DataFrame(columns=['O3','CO','PM10','SO2','NO2'])
+        files = [f.result() for f in futures] #raises the error of any request that failed after retries
 
-        #adds a date column and creates daily information
-        df['FECHA'] = pd.date_range(start = pd.Timestamp(year), 
-                                   end = pd.Timestamp(year) + pd.tseries.offsets.YearEnd(0),
-                                   freq = 'D')
+    return (files)
 
-        df = df.set_index('FECHA')
-        df = df.stack(dropna=False) #stacks DataFrame so for every date there are 5 rows with criterion pollutants
-        all_data = pd.DataFrame(df) #passes inforation to new DataFrame
-        all_data = all_data.rename_axis(index=['FECHA','PARAM']) #sets dates and pollutants as index
-        all_data = all_data.drop(columns=[0]) #removes empty column
-        
 
-        for s in sheets:
-            
-            #reads excel with data and sets empty cells as nan
-            gdl_data = pd.read_excel(dir_gdl+file, sheet_name = s).rename(columns={'Fecha':'FECHA',
-                                                                                   'Hora':'HORA'}).replace(r'^\s*$', 
-                                                                                                           np.nan, 
-                                                                                                           regex=True)
-            gdl_data.columns = [col.strip() for col in gdl_data.columns] #removes spaces from columns
-            
-            gdl_data = gdl_data[['FECHA','O3','NO2','SO2','PM10','CO']] #filters data
-
-            gdl_data['FECHA'] = gdl_data['FECHA'].dt.date
-
-            #stacks gdl DataFrame so for every date there are 5 rows with criterion pollutants
-            gdl_stack = pd.DataFrame(gdl_data.set_index(['FECHA']).stack([0]))
-
-            #changes name from stacked column with concentration information
-            gdl_stack = gdl_stack.reset_index().rename(columns={'level_1':'PARAM',
-                                                                0:est_dict[s.strip(' ').upper()]})
-            
-            gdl_stack['FECHA'] = pd.to_datetime(gdl_stack['FECHA'])
-            
-            #because the data base contains dates out from the analyzed year the DataFrame is filtered
-            gdl_stack = gdl_stack[gdl_stack['FECHA'].dt.year==int(file[6:10])]
-
-            #removes sapces from sheet names and sets columns as numbers avoiding spaces
-            gdl_stack[est_dict[s.strip(' ').upper()]] = pd.to_numeric(gdl_stack[est_dict[s.strip(' ').upper()]], errors='coerce')
-
-            gdl_stack = gdl_stack.groupby(['FECHA','PARAM']).mean()
-
-            #adds data from gdl_stack for a specified year to all_data which 
-            #will contain information for every year
-            all_data = pd.merge(all_data, gdl_stack, how='outer',left_index=True, right_index=True)
-            
-        
-        all_data.to_csv(dir_gdl+'stack/'+file[6:10]+'.csv') #saves data for all years, stations and parameters
+def data_sinaica(city, num_datos, workers=1, retries=3, backoff=1.0, fetch=None, page_size=None):
+    """Function that downloads csv with from SINAICA for a given city
 
+    Args:
+        city {str} -- code for city to be downloaded
+        num_datos {int} -- number of records requested for every pollutant
+        workers {int} -- maximum number of concurrent requests, set to 1 by default
+        retries {int} -- number of retries for a failed request, set to 3 by default
+        backoff {float} -- seconds waited before the first retry, doubled on every retry, set to 1.0 by default
+        fetch {callable} -- function with the signature of client.makeCall(endpoint, params) used for the requests,
+                            set to cached_call by default
+        page_size {int} -- if specified, records are requested in pages of page_size and streamed to a jsonl file,
+                           a failed download continues from the last page saved, set to None by default
 
+    Return
+        csv  -- csv with air quality data for the specified city from the SINAICA database
 
-def aqip_mx(month_limit=5, year_limit=2020):
+    """
+    data_sinaica_mx([city], num_datos, workers=workers, retries=retries, backoff=backoff, fetch=fetch,
+                    page_size=page_size)
 
-    """Creates two csv files with data from the Air Quality Index Project for mexican cities. 
-        The first contains data from the criterion pollutants for the mexican cities in the AQIP database, 
-        from January to month_limit, set by default to May, from 2017 to year_limit, set by default to 2020
-        The second contains the ammount of dates with data for every city and pollutant and a percentage of
-        the total options available
+def _manifest_from_csv(csv_file, chunksize=100000):
+    """Function that builds the latest date downloaded by station from an existing SINAICA csv
 
     Args:
-        year_limit{int} -- int with limit year to be analyzed, set to 2020 by default
-        month_limit {int} -- int with limit month to be analyzed, set to 5 (May) by default
+        csv_file {str} -- path to csv with SINAICA records
+        chunksize {int} -- number of rows read at a time, set to 100000 by default
 
     Returns:
-        csv -- data from the criterion pollutants for the mexican cities in the AQIP database
-        csv -- ammount of dates with data for every city and pollutant and a percentage of the total options available
+        dict -- dictionary with station id as key and latest date as value
     """
-    
-    dir_pcs_aqip = '../data/processed/aqip/'
-    
-    aqip_mx = pd.read_csv(dir_pcs_aqip+'MX_2015_'+str(year_limit)+'.csv') #Data from AQIP filtered for mexican cities
-    
-    aqip_mx['Date'] = pd.to_datetime(aqip_mx['Date'])
+    hwm = {}
 
-    aqip_mx2 = pd.DataFrame()
-    
-    stat_city = pd.DataFrame(columns=['City','Specie','Count','Pctg','Count_avg','Pctg_avg'])
+    for chunk in pd.read_csv(csv_file, usecols=['estacionesid','date'], dtype=str, chunksize=chunksize):
+        for est, date in chunk.dropna().groupby('estacionesid')['date'].max().items():
+            if date > hwm.get(est, ''):
+                hwm[est] = date
 
-    for year in range(2017,year_limit+1):
+    return (hwm)
 
-        aqip_mx2 = aqip_mx2.append(aqip_mx[aqip_mx['Date'].dt.year==year]) #Dissmisses years not in range
 
-    
-    cities = aqip_mx.groupby(['City']).count()
-    
-    city = cities.index.tolist() #List of cities in the database
+def sync_sinaica(city, page_size=10000, retries=3, backoff=1.0, fetch=None):
+    """Function that downloads only the SINAICA records newer than the ones already stored for a city.
+        A manifest in data/raw/<city>/manifest.json keeps the latest date downloaded for every pollutant
+        and station; new records are requested from the oldest of those dates, filtered by station and
+        appended to data/raw/<city>/<pollutant>/<city>_<pollutant>.csv
 
+    Args:
+        city {str} -- code for city to be synchronized
+        page_size {int} -- number of records per page, set to 10000 by default
+        retries {int} -- number of retries for a failed page, set to 3 by default
+        backoff {float} -- seconds waited before the first retry, doubled on every retry, set to 1.0 by default
+        fetch {callable} -- function with the signature of client.makeCall(endpoint, params) used for the requests,
+                            set to client.makeCall by default
 
-    for i in range (5):
+    Returns:
+        dict -- number of new records for every pollutant
+    """
+    dir_raw = '../data/raw/' #directory for raw data
 
-        df = pd.DataFrame()
+    if fetch is None:
+        fetch = client.makeCall
 
-        for year in range(2017,year_limit+1):
+    manifest_file = dir_raw+city+'/manifest.json'
 
-            df2 = pd.DataFrame()
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open (manifest_file,'r') as aux:
+            manifest = json.load(aux)
 
-            y=str(year)
-            
-            month = str(month_limit) #adds month to string
-             
-            if month_limit<10:
-                month = '0'+str(month_limit) #if month is smaller than 10 it adds a zero
+    new_records = {}
 
-            #specifies day depending on month
-            if month == '2':
-                day = '29'
-            
-            elif month in {1, 3, 5, 7, 8, 10, 12}:
-                day = '31'
+    for i in range(5):
 
-            else:
-                day = '30'
+        p = src.pollutant(i)
+        os.makedirs(dir_raw+city+'/'+p, exist_ok=True)
 
+        filename = dir_raw+city+'/'+p+'/'+city+'_'+p
+        delta = filename+'_delta'
 
-            df2['Date'] = pd.date_range(start = pd.Timestamp(y), 
-                                           end = pd.Timestamp(y+'-'+month+'-'+day)  ,
-                                           freq = 'D')
-            df = df.append(df2) #Creates database with days from January to month_limit for the years in range
-            
+        #builds the manifest from data downloaded before the first sync
+        if p not in manifest:
+            manifest[p] = _manifest_from_csv(filename+'.csv') if os.path.isfile(filename+'.csv') else {}
 
-        c_data = aqip_mx2[aqip_mx2['Specie']==src.pollutant(i)] #Creates a column with the pollutant analyzed
+        hwm = manifest[p]
 
-        c_data = c_data.set_index('Date')
+        params = {'city':src.city_name(city), 'parametro':p}
 
-        for c in city:
+        #requests records from the oldest date among stations, the api returns all records when there is no date
+        if len(hwm) > 0:
+            params['date'] = '>'+min(hwm.values())
 
-            #Adds the data for every city for the specified pollutant to the DataFrame with all dates
-            df=df.merge(c_data[c_data['City']==c]['c_median'], how='left', on='Date').rename(columns={'c_median':c})
-            
-        
-        df = df.set_index('Date')
+        _sinaica_pages(delta, params, None, page_size, fetch, retries, backoff)
 
-        #Creates DataFrame to count presence of data by city and pollutant
-        res_data = pd.DataFrame(df.stack())
-        
-        res_data = res_data.reset_index().drop(columns=['Date']).rename(columns={'level_1':'City',
-                                                                     0:'Count'}).groupby('City').count()
+        data = pd.read_csv(delta+'.csv', dtype={'estacionesid':str})
 
-        res_data['Pctg'] = res_data['Count']/len(df)
-            
-        df = df.rolling(7, min_periods=1).mean()
-        
-        #Creates DataFrame to count presence of data by city and pollutant after weekly average
-        res_data2 = pd.DataFrame(df.stack())
-        res_data2 = res_data2.reset_index().drop(columns=['Date']).rename(columns={'level_1':'City',
-                                                             0:'Count_avg'}).groupby('City').count()
-        
-        res_data2['Pctg_avg'] = res_data2['Count_avg']/len(df)
-        res_data = res_data.merge(res_data2, how='outer', on='City')
-        
-        res_data['Specie'] = src.pollutant(i)
-        
-        stat_city = stat_city.append(res_data.reset_index())
+        #keeps only records newer than the latest date of their station, pollutants without records are skipped
+        if len(data) > 0:
+            last = data['estacionesid'].map(hwm).fillna('').astype(str)
+            data = data[data['date'].astype(str) > last].drop_duplicates(subset='id')
 
-        #Saves csv with city data by pollutant    
-        df.to_csv(dir_pcs_aqip+'MX_'+src.pollutant(i)+'_'+str(2017)+'-'+str(year_limit)+'.csv')
-           
-    #Sets multiindex for stat_city
-    stat_city = stat_city.set_index(['City','Specie'])
-    
-    specie = [src.pollutant(i) for i in range(5)]*15
-    
-    city2 = city*5
-    
-    city2.sort()
+        if len(data) > 0:
 
-    index =[city2,specie]
+            if os.path.isfile(filename+'.csv'):
+                columns = pd.read_csv(filename+'.csv', nrows=0).columns
+                data.reindex(columns=columns).to_csv(filename+'.csv', mode='a', index=False, header=False)
 
-    tuples = list(zip(*index))
+            else:
+                data.to_csv(filename+'.csv', index=False)
 
-    index = pd.MultiIndex.from_tuples(tuples, names=['City','Specie'])
-    
-    stat_city = stat_city.reindex(index)
-    
-    #Saves csv with data ammount of dates with data for every city 
-    # and pollutant and a percentage of the total options available
-    stat_city.to_csv(dir_pcs_aqip+'MX_StatRes_'+str(2017)+'-'+str(year_limit)+'.csv')
\ No newline at end of file
+            hwm.update(data.groupby('estacionesid')['date'].max().to_dict())
+
+        os.remove(delta+'.csv')
+        os.remove(delta+'.jsonl')
+
+        new_records[p] = len(data)
+
+        _write_state(manifest_file, manifest) #saves progress after every pollutant
+
+    return (new_records)
+
+
+def stations_csv(ttl=86400):
+    """Function that downloads csv with information for all Mexican air quality stations using SINAICA api
+
+    Args:
+        ttl {float} -- seconds a cached api response is reused, set to 86400 (one day) by default
+
+    Returns:
+        csv -- csv with information for all air quality stations from the SINAICA database
+
+    """
+        
+    parametros_request = cached_call('sinaica-estaciones',{'pageSize':200}, ttl=ttl) #calls datosgobmx function and gathers data
+    dir_raw_grl = '../data/raw/Grl/'
+
+    stations = [] #list which saves station information
+
+    #gathers data from all stations and interates over them
+    for v in parametros_request['results']:
+        aux = pd.DataFrame.from_dict(v,orient='index').T
+        stations.append(aux)
+
+    stations = pd.concat(stations, ignore_index=True)
+
+    #Removes stations that are out of Mexico
+    mask = (stations.lat.between(14, 34.5)) & (stations.long.between(-120, -70))
+    stations = stations[mask]
+
+    filename = dir_raw_grl+'estaciones'
+
+    stations.to_csv (r''+filename+'.csv', index = False, header=True) #saves to csv
+
+
+def read_aq_csv(filename, index_col=None, usecols=None, encoding=None, chunksize=None):
+    """Function that reads a processed air quality csv with a fixed schema: pollutant, city and station names
+        as categories, dates parsed with AQ_DATE_FORMAT and concentrations as float32
+
+    Args:
+        filename {str} -- path to csv
+        index_col {str or list} -- column or columns set as index after the schema is applied, set to None by default
+        usecols {list} -- columns to be read, all by default
+        encoding {str} -- encoding of the csv, set to None by default
+        chunksize {int} -- if specified, returns an iterator of DataFrames with chunksize rows
+
+    Returns:
+        DataFrame -- DataFrame with the schema applied, or iterator of DataFrames when chunksize is specified
+    """
+    columns = pd.read_csv(filename, nrows=0, usecols=usecols, encoding=encoding).columns
+
+    dtype = {}
+    for col in columns:
+        if col in AQ_CATEGORIES:
+            dtype[col] = 'category'
+        elif col in AQ_DATES:
+            dtype[col] = str
+        else:
+            dtype[col] = np.float32
+
+    def apply_schema(data):
+        for col in data.columns.intersection(AQ_DATES):
+            data[col] = pd.to_datetime(data[col], format=AQ_DATE_FORMAT)
+        if index_col is not None:
+            data = data.set_index(index_col)
+        return (data)
+
+    #skipping initial spaces turns cells with only spaces into empty cells, which are parsed as nan
+    reader = pd.read_csv(filename, usecols=usecols, encoding=encoding, dtype=dtype, skipinitialspace=True,
+                         chunksize=chunksize)
+
+    if chunksize is not None:
+        return (apply_schema(chunk) for chunk in reader)
+
+    return (apply_schema(reader))
+
+
+def _read_stack(filename, chunksize=None):
+    """Function that reads a stacked csv of air quality data with the schema of read_aq_csv, cells with only spaces are read as nan
+
+    Args:
+        filename {str} -- path to csv with the columns PARAM, FECHA and one column per station
+        chunksize {int} -- if specified, returns an iterator of DataFrames with chunksize rows
+
+    Returns:
+        DataFrame -- DataFrame indexed by PARAM and FECHA, or iterator of DataFrames when chunksize is specified
+    """
+    return (read_aq_csv(filename, index_col=['PARAM','FECHA'], chunksize=chunksize))
+
+
+def merge_aq(city, year_limit=2020, workers=4, stream=False, chunksize=100000, save=True):
+    """Function that merges the databases from air quality stations for a given city 
+        into a single csv from a period starting at 2017 and ending at year_limit, set to default at 2020
+
+    Args:
+        city {str} -- string containing city code to be analyzed
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        workers {int} -- number of yearly files read in parallel, set to 4 by default.
+                         Years without stack/<year>.csv and with a <yy>RAMA directory are stacked with rama_data,
+                         other years without stack/<year>.csv are left out and printed
+        stream {bool} -- if True, yearly files are written to the output in chunks instead of being
+                         merged in memory, set to False by default
+        chunksize {int} -- number of rows read at a time when stream is True, set to 100000 by default
+        save {bool} -- if False, the merged data is only returned and no csv is written, set to True by default
+
+    Returns:
+        csv -- csv with all the data from air quality stations
+        DataFrame -- DataFrame indexed by PARAM and FECHA with all the data, None when stream is True
+    """
+
+    dir_raw = '../data/raw/'
+    dir_pcs = '../data/processed/'
+
+    files = [dir_raw+city+'/stack/'+str(year)+'.csv' for year in range(2017,year_limit+1)]
+
+    #years of cities with RAMA workbooks, like cdmx, are stacked first when their stack does not exist
+    rama = [year for year in range(2017,year_limit+1) if not os.path.isfile(files[year-2017]) and
+            os.path.isdir(dir_raw+city+'/'+str(year)[-2:]+'RAMA')]
+    if len(rama) > 0:
+        rama_data(city, years=rama)
+
+    #years after the last one with data, like 2020 for gdl, are left out, the output keeps the name of the
+    #period requested so the next stages find it
+    missing = [str(year) for year, file in zip(range(2017,year_limit+1), files) if not os.path.isfile(file)]
+    files = [file for file in files if os.path.isfile(file)]
+    if len(files) == 0:
+        raise FileNotFoundError('no stack files for '+city+' from 2017 to '+str(year_limit))
+    if len(missing) > 0:
+        print('merge_aq '+city+': no stack files for '+', '.join(missing)+', merged without them')
+    
+    filename = dir_pcs + city + '/' + city + '_' + str(2017)+'-'+str(year_limit)
+
+    if stream:
+
+        #gathers the stations of every year so all chunks are written with the same columns
+        columns = []
+        for file in files:
+            for col in pd.read_csv(file, nrows=0).columns:
+                if col not in ('PARAM','FECHA') and col not in columns:
+                    columns.append(col)
+
+        with open (r''+filename+'.csv','w') as outfile:
+            outfile.write(','.join(['PARAM','FECHA']+columns)+'\n')
+
+            for file in files:
+                for chunk in _read_stack(file, chunksize=chunksize):
+                    chunk.reindex(columns=columns).to_csv(outfile, header=False)
+
+        return
+
+    #access air quality data for every year in parallel
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        data = list(pool.map(_read_stack, files))
+
+    all_data = pd.concat(data, sort=False) #DataFrame that will contain all data
+
+    if save:
+        all_data.to_csv (r''+filename+'.csv', index = True, header=True) #saves DataFrame to csv
+
+    return (all_data)
+
+def _chunked_mean(chunks, keys):
+    """Function that calculates the mean of every column by keys from an iterator of DataFrames, keeping
+        only the sum and count by key of the chunks read so far
+
+    Args:
+        chunks {iterator} -- iterator of DataFrames indexed by keys
+        keys {list} -- index levels to group by
+
+    Returns:
+        DataFrame -- DataFrame with the mean by keys, as float32, with the levels in AQ_DATES as datetime
+    """
+    sums, counts = None, None
+
+    for chunk in chunks:
+        #categories change between chunks, keys are compared as strings
+        chunk.index = chunk.index.set_levels([level.astype(str) for level in chunk.index.levels])
+
+        group = chunk.astype(np.float64).groupby(level=keys)
+        chunk_sum, chunk_count = group.sum(), group.count()
+
+        if sums is None:
+            sums, counts = chunk_sum, chunk_count
+        else:
+            sums = sums.add(chunk_sum, fill_value=0)
+            counts = counts.add(chunk_count, fill_value=0)
+
+    mean = sums/counts.where(counts > 0)
+
+    #date levels are parsed back so the result has the same index types as a groupby of the whole file
+    mean.index = mean.index.set_levels([pd.to_datetime(level) if level.name in AQ_DATES else level
+                                        for level in mean.index.levels])
+
+    return (mean.sort_index().astype(np.float32))
+
+
+def res_aqdata(city, year_limit=2020, chunksize=None, data=None, save=True):
+    """Function that groups data from air quality stations by date and parameter for every station from 
+        a period starting at 2017 and ending at year_limit, set to default at 2020
+
+    Args:
+        city {str} -- string containing city code to be analyzed
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        chunksize {int} -- if specified, the csv is read in chunks of chunksize rows and only the sum
+                           and count by pollutant and date are kept in memory, set to None by default
+        data {DataFrame} -- merged data indexed by PARAM and FECHA as returned by merge_aq, if None the csv
+                            written by merge_aq is read, set to None by default
+        save {bool} -- if False, the result is only returned and no csv is written, set to True by default
+
+    Returns:
+        csv -- csv with sumarized data
+        DataFrame -- DataFrame with the mean by pollutant and date for every station
+    """
+
+    dir_pcs = '../data/processed/'+city+'/' #directory for processed data
+
+    filename = dir_pcs +city+'_'+ str(2017)+'-'+str(year_limit)+'.csv'
+
+    if data is None and chunksize is not None:
+        res_data = _chunked_mean(read_aq_csv(filename, index_col = ['PARAM','FECHA'], chunksize=chunksize),
+                                 ['PARAM','FECHA'])
+    else:
+        if data is None:
+            data = read_aq_csv(filename, index_col = ['PARAM','FECHA']) 
+
+        res_data = data.groupby(['PARAM','FECHA'], observed=True).mean() #calculates mean for pollutant and date
+    
+    if save:
+        res_data.to_csv (r''+dir_pcs +'res_'+ str(2017)+'-'+str(year_limit)+'.csv', index = True, header=True) #saves csv
+
+    return (res_data)
+    
+    
+def aq_daily_median(city, year_limit=2020, chunksize=None, data=None, save=True):
+    """Function that calculates the median by day for a given city and pollutant from 
+        a period starting at 2017 and ending at year_limit, set to default at 2020
+
+    Args:
+        city {str} -- city code to calculate median
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        chunksize {int} -- if specified, the csv is read and written in chunks of chunksize rows, set to None by default
+        data {DataFrame} -- data indexed by PARAM and FECHA as returned by res_aqdata, if None the csv written
+                            by res_aqdata is read, set to None by default
+        save {bool} -- if False, the result is only returned and no csv is written, set to True by default
+
+    Returns:
+        csv -- csv for the date and calculated median
+        Series -- median by pollutant and date
+    """
+
+    dir_pcs = '../data/processed/'+city+'/'
+
+    filename = dir_pcs+'res_'+ str(2017)+'-'+str(year_limit)+'.csv'
+    output = dir_pcs+'median_res_'+ str(2017)+'-'+str(year_limit)+'.csv'
+
+    if data is None and chunksize is not None:
+        #the median is taken across the stations of each day, so every chunk of days is exact on its own
+        #and only the median, one value per pollutant and day, is kept
+        medians = []
+        for n, chunk in enumerate(read_aq_csv(filename, index_col = ['PARAM','FECHA'], chunksize=chunksize)):
+            medians.append(chunk.median(axis=1))
+
+            if save:
+                medians[-1].to_csv(output, mode='w' if n == 0 else 'a', header=(n == 0))
+
+        aq_median_data = pd.concat(medians)
+
+        #categories of each chunk differ, PARAM is set back to a category as in a csv read at once
+        aq_median_data.index = aq_median_data.index.set_levels(aq_median_data.index.levels[0].astype('category'),
+                                                               level='PARAM')
+
+        return (aq_median_data)
+
+    if data is None:
+        data = read_aq_csv(filename, index_col = ['PARAM','FECHA'])
+
+    aq_median_data = data.median(axis=1)
+    
+    if save:
+        aq_median_data.to_csv(output)
+
+    return (aq_median_data)
+
+
+def _aqip_file(filename, country, species, chunksize):
+    """Function used by aqip_data that reads an AQIP csv in chunks keeping only the rows of a country and species
+
+    Args:
+        filename {str} -- path to AQIP csv
+        country {str} -- country code, for example: MX
+        species {list} -- pollutants in capital letters to be kept, None keeps every pollutant
+        chunksize {int} -- number of rows read at a time
+
+    Returns:
+        DataFrame -- DataFrame with the rows of the country, without rows and with the columns in AQIP_COLS
+                     when the file has no data
+    """
+    dtype = {'Date':str, 'Country':'category', 'City':'category', 'Specie':'category',
+             'count':np.float32, 'min':np.float32, 'max':np.float32, 'median':np.float32, 'variance':np.float32}
+
+    data = []
+
+    for chunk in pd.read_csv(filename, skiprows=4, usecols=list(dtype), dtype=dtype, chunksize=chunksize):
+
+        chunk = chunk[chunk['Country']==country] #filters for the country
+
+        #changes pollutants to capital letters, only for the rows of the country
+        chunk = chunk.drop(columns=['Country']).astype({'City':str, 'Specie':str})
+        chunk['Specie'] = chunk['Specie'].str.upper()
+
+        if species is not None:
+            chunk = chunk[chunk['Specie'].isin(species)]
+
+        data.append(chunk)
+
+    if len(data) == 0: #files without rows
+        return (_aqip_empty())
+
+    return (pd.concat(data, ignore_index=True))
+
+
+def _aqip_empty():
+    #DataFrame without rows with the columns and types returned by _aqip_file
+    return (pd.DataFrame(columns=AQIP_COLS).astype({col:(str if col in ['Date','City','Specie'] else np.float32)
+                                                    for col in AQIP_COLS}))
+
+
+def aqip_data(species=('O3','CO','PM10','PM25','NO2','SO2'), processes=None, chunksize=500000):
+    """Function that extracts data for mexican city from the Air Quality Index Project database.
+        Files are read in parallel and in chunks, keeping only rows for Mexico and the pollutants in species
+
+    Args:
+        species {list} -- pollutants to be kept, None keeps every pollutant, set to the criterion pollutants by default
+        processes {int} -- number of worker processes, set to the number of cores by default
+        chunksize {int} -- number of rows read at a time by each worker, set to 500000 by default
+
+    Returns:
+        csv -- csv with AQIP data for mexican cities
+
+    """
+    dir_raw_aqip = '../data/raw/AirQualityIndexProject/world_data/'
+    dir_pcs_aqip = '../data/processed/aqip/'
+    
+    #reads all csv files from specified directory 
+    files = [dir_raw_aqip + file for file in sorted(os.listdir(dir_raw_aqip))]
+
+    n = len(files)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        data = list(pool.map(_aqip_file, files, ['MX']*n, [species]*n, [chunksize]*n))
+
+    #without files the csv is written with its columns and no rows
+    all_data = pd.concat(data if len(data) > 0 else [_aqip_empty()], ignore_index=True).set_index(['Specie'])
+        
+    #Calculates a new column with the data converted from 
+    #air quality index to concentration by pollutant
+
+    all_data['c_median'] = src.aqi_to_conc(all_data['median'].to_numpy(), all_data.index.to_numpy())
+    
+    all_data = all_data.reset_index().set_index(['City','Specie','Date'])
+
+    all_data.to_csv(AQIP_MX_CSV)
+    
+    
+def _file_hash(filename, blocksize=2**20):
+    """Function that calculates the sha256 of the contents of a file
+
+    Args:
+        filename {str} -- path to file
+        blocksize {int} -- number of bytes read at a time, set to 1 MB by default
+
+    Returns:
+        str -- hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+
+    with open (filename,'rb') as aux:
+        for block in iter(lambda: aux.read(blocksize), b''):
+            digest.update(block)
+
+    return (digest.hexdigest())
+
+
+def read_excel_cached(filename, sheet_name=0, cache_dir='../data/interim/excel_cache/'):
+    """Function that reads an excel workbook through a cache of parsed sheets saved as parquet. Sheets are
+        saved under the hash of the workbook contents, so excel is only parsed again when the file changes
+
+    Args:
+        filename {str} -- path to excel workbook
+        sheet_name {str, int or None} -- sheet name or position to be read, None reads every sheet, set to 0 by default
+        cache_dir {str} -- directory of the cache, set to data/interim/excel_cache/ by default
+
+    Returns:
+        DataFrame -- DataFrame with the sheet, or dictionary with a DataFrame per sheet when sheet_name is None
+    """
+    import pyarrow
+
+    key = os.path.join(cache_dir, _file_hash(filename))
+
+    #reads the workbook and saves every sheet the first time its contents are seen
+    if not os.path.isfile(key+'.json'):
+
+        sheets = pd.read_excel(filename, sheet_name=None)
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        for n, sheet in enumerate(sheets.values()):
+            try:
+                sheet.to_parquet(key+'_'+str(n)+'.parquet', index=False)
+
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                #columns mixing numbers and text, like blank cells with spaces, are saved as text
+                obj = sheet.select_dtypes(include='object').columns
+                sheet.astype({col:'string' for col in obj}).to_parquet(key+'_'+str(n)+'.parquet', index=False)
+
+        #the sheet names are written last and mark the entry as complete
+        _write_state(key+'.json', list(sheets.keys()))
+
+    with open (key+'.json','r') as aux:
+        names = json.load(aux)
+
+    def read_sheet(n):
+        return (pd.read_parquet(key+'_'+str(n)+'.parquet'))
+
+    if sheet_name is None:
+        return ({name:read_sheet(n) for n, name in enumerate(names)})
+
+    n = sheet_name if isinstance(sheet_name, int) else names.index(sheet_name)
+
+    return (read_sheet(n))
+
+
+def _gdl_sheet(gdl_data, year):
+    """Function that converts a sheet of a SIMAJ workbook to daily means by date and pollutant
+
+    Args:
+        gdl_data {DataFrame} -- DataFrame read from a station sheet of a SIMAJ workbook
+        year {int} -- year of the workbook, dates from other years are removed
+
+    Returns:
+        Series -- daily mean concentration indexed by FECHA and PARAM
+    """
+    gdl_data = gdl_data.rename(columns={'Fecha':'FECHA', 'Hora':'HORA'})
+    gdl_data.columns = [col.strip() for col in gdl_data.columns] #removes spaces from columns
+
+    gdl_data = gdl_data[['FECHA','O3','NO2','SO2','PM10','CO']] #filters data
+
+    gdl_data['FECHA'] = pd.to_datetime(gdl_data['FECHA']).dt.normalize()
+
+    #because the data base contains dates out from the analyzed year the DataFrame is filtered
+    gdl_data = gdl_data[gdl_data['FECHA'].dt.year==year].set_index('FECHA')
+
+    #sets columns as numbers, empty cells and cells with spaces become nan
+    gdl_data = gdl_data.apply(pd.to_numeric, errors='coerce')
+
+    #stacks gdl DataFrame so for every date there are 5 rows with criterion pollutants
+    gdl_stack = gdl_data.stack().rename_axis(['FECHA','PARAM'])
+
+    return (gdl_stack.groupby(level=['FECHA','PARAM']).mean())
+
+
+def _gdl_workbook(dir_gdl, file):
+    """Function used by gdl_data that converts a yearly SIMAJ workbook to stack/<year>.csv
+
+    Args:
+        dir_gdl {str} -- directory with SIMAJ workbooks
+        file {str} -- name of the workbook, the year is in characters 6 to 10
+
+    Returns:
+        str -- path of the csv written
+    """
+    #dictionary for stations codes and names
+    est_dict = {'ÁGUILAS':'AGU', 'ATEMAJAC':'ATM', 'CENTRO':'CEN', 
+                'LAS PINTAS':'PIN', 'LOMA DORADA':'LDO', 'MIRAVALLE':'MIR', 'OBLATOS':'OBL', 
+                'SANTA FE':'SFE', 'TLAQUEPAQUE':'TLA', 'VALLARTA':'VAL'} 
+
+    year = file[6:10] #gathers the year from the file name
+
+    #SIMAJ data is in xls and in different sheets, all sheets are read at once through the cache of parsed sheets
+    sheets = read_excel_cached(dir_gdl+file, sheet_name=None)
+
+    #daily means of every station, each station in a column
+    stations = {est_dict[s.strip(' ').upper()]:_gdl_sheet(gdl_data, int(year)) for s, gdl_data in sheets.items()}
+
+    all_data = pd.concat(stations, axis=1) #joins all stations at once by date and pollutant
+
+    #adds every date of the year for the 5 criterion pollutants, including dates without data
+    index = pd.MultiIndex.from_product([pd.date_range(start = pd.Timestamp(year), 
+                                                      end = pd.Timestamp(year) + pd.tseries.offsets.YearEnd(0),
+                                                      freq = 'D'),
+                                        ['O3','CO','PM10','SO2','NO2']], names=['FECHA','PARAM'])
+
+    all_data = all_data.reindex(all_data.index.union(index)).sort_index()
+
+    all_data.to_csv(dir_gdl+'stack/'+year+'.csv') #saves data for the year, stations and parameters
+
+    return (dir_gdl+'stack/'+year+'.csv')
+
+
+def gdl_data (processes=None):
+    """Function that merges and adjusts format for SIMAJ database for Guadalajara's stations,
+        every yearly workbook is processed in a process pool
+
+    Args:
+        processes {int} -- number of worker processes, set to the number of cores by default
+
+    Returns:
+        csv -- csv with the daily data by station and pollutant for every year in data/raw/gdl/stack/
+    
+    """
+
+    dir_gdl = '../data/raw/gdl/'
+    
+    #check for file or directory in dir_gdl
+    files = [file for file in os.listdir(dir_gdl) if os.path.isfile(os.path.join(dir_gdl,file))]
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        list(pool.map(_gdl_workbook, [dir_gdl]*len(files), files))
+
+
+
+def _rama_workbook(filename, year, pollutant):
+    """Function used by rama_data that converts a RAMA workbook of a year and pollutant to daily means by station,
+        -99 is replaced with nan before the means are calculated
+
+    Args:
+        filename {str} -- path to RAMA workbook, with columns FECHA, HORA and one column per station
+        year {int} -- year of the workbook, dates from other years are removed
+        pollutant {str} -- chemical formula of the pollutant of the workbook
+
+    Returns:
+        DataFrame -- daily mean concentration indexed by FECHA and PARAM, one column per station
+    """
+    rama = read_excel_cached(filename)
+
+    rama.columns = [str(col).strip() for col in rama.columns] #removes spaces from columns
+    rama = rama.drop(columns=['HORA'], errors='ignore')
+
+    rama['FECHA'] = pd.to_datetime(rama['FECHA']).dt.normalize()
+    rama = rama[rama['FECHA'].dt.year==year].set_index('FECHA')
+
+    #sets columns as numbers, empty cells and cells with spaces become nan
+    rama = rama.apply(pd.to_numeric, errors='coerce')
+
+    #-99 marks hours without data, columns read as integers keep it after parsing
+    rama = rama.mask(rama == -99).groupby(level='FECHA').mean()
+
+    rama['PARAM'] = pollutant
+
+    return (rama.set_index('PARAM', append=True))
+
+
+def rama_data(city='cdmx', years=None, processes=None):
+    """Function that merges and adjusts format for RAMA database for Mexico City's stations. Workbooks in
+        data/raw/<city>/<yy>RAMA/<year><pollutant>.xls are read in a process pool, one per year and pollutant,
+        and saved as daily means by station with the layout of gdl_data
+
+    Args:
+        city {str} -- city code of the RAMA directories, set to cdmx by default
+        years {list} -- years to be stacked, every year with a RAMA directory by default
+        processes {int} -- number of worker processes, set to the number of cores by default
+
+    Returns:
+        csv -- csv with the daily data by station and pollutant for every year in data/raw/<city>/stack/
+    """
+
+    dir_city = '../data/raw/'+city+'/'
+
+    pollutants = ['O3','CO','PM10','SO2','NO2']
+
+    #year and pollutant of every criterion pollutant workbook, years are read from the file names
+    workbooks = []
+    for folder in sorted(os.listdir(dir_city)):
+        if not re.fullmatch(r'\d{2}RAMA', folder):
+            continue
+        for file in sorted(os.listdir(dir_city+folder)):
+            name = re.fullmatch(r'(\d{4})(\w+)\.xls', file)
+            if name and name.group(2) in pollutants and (years is None or int(name.group(1)) in years):
+                workbooks.append((dir_city+folder+'/'+file, int(name.group(1)), name.group(2)))
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        data = list(pool.map(_rama_workbook, *zip(*workbooks))) if len(workbooks) > 0 else []
+
+    os.makedirs(dir_city+'stack/', exist_ok=True)
+
+    for year in sorted(set(w[1] for w in workbooks)):
+
+        all_data = pd.concat([d for d, w in zip(data, workbooks) if w[1]==year], sort=False)
+        all_data = all_data.reorder_levels(['FECHA','PARAM'])
+
+        #adds every date of the year for the 5 criterion pollutants, including dates without data
+        index = pd.MultiIndex.from_product([pd.date_range(start = pd.Timestamp(year,1,1), 
+                                                          end = pd.Timestamp(year,12,31),
+                                                          freq = 'D'),
+                                            pollutants], names=['FECHA','PARAM'])
+
+        all_data = all_data.reindex(all_data.index.union(index)).sort_index()
+
+        all_data.to_csv(dir_city+'stack/'+str(year)+'.csv') #saves data for the year, stations and parameters
+
+
+def aqip_mx(month_limit=5, year_limit=2020):
+
+    """Creates two csv files with data from the Air Quality Index Project for mexican cities. 
+        The first contains data from the criterion pollutants for the mexican cities in the AQIP database, 
+        from January to month_limit, set by default to May, from 2017 to year_limit, set by default to 2020
+        The second contains the ammount of dates with data for every city and pollutant and a percentage of
+        the total options available
+
+    Args:
+        year_limit{int} -- int with limit year to be analyzed, set to 2020 by default
+        month_limit {int} -- int with limit month to be analyzed, set to 5 (May) by default
+
+    Returns:
+        csv -- data from the criterion pollutants for the mexican cities in the AQIP database
+        csv -- ammount of dates with data for every city and pollutant and a percentage of the total options available
+    """
+    
+    dir_pcs_aqip = '../data/processed/aqip/'
+    
+    aqip_mx = read_aq_csv(AQIP_MX_CSV) #Data from AQIP filtered for mexican cities
+
+    pollutants = [src.pollutant(i) for i in range(5)]
+
+    city = sorted(aqip_mx['City'].dropna().unique().tolist()) #List of cities in the database
+
+    #Creates calendar with days from January to the end of month_limit for the years in range
+    dates = pd.DatetimeIndex(np.concatenate([pd.date_range(start = pd.Timestamp(year,1,1),
+                                                           end = pd.Timestamp(year,month_limit,1) + pd.offsets.MonthEnd(0),
+                                                           freq = 'D').values
+                                             for year in range(2017,year_limit+1)]), name='Date')
+
+    aqip_mx = aqip_mx[aqip_mx['Specie'].isin(pollutants) & aqip_mx['Date'].isin(dates)]
+
+    #Date x (pollutant, city) table for all pollutants at once
+    table = aqip_mx.pivot_table(index='Date', columns=['Specie','City'], values='c_median',
+                                aggfunc='mean', observed=True, dropna=False)
+
+    table = table.reindex(index=dates, columns=pd.MultiIndex.from_product([pollutants, city],
+                                                                          names=['Specie','City'])).astype(float)
+
+    #Weekly average, computed over the calendar rows as in the city csv
+    table_avg = table.rolling(7, min_periods=1).mean()
+
+    #Counts presence of data by city and pollutant, before and after weekly average
+    stat_city = pd.DataFrame({'Count':table.count(), 'Count_avg':table_avg.count()})
+
+    stat_city['Pctg'] = stat_city['Count']/len(table)
+    stat_city['Pctg_avg'] = stat_city['Count_avg']/len(table)
+
+    #cities without data for a pollutant are left empty
+    stat_city = stat_city[stat_city['Count'] > 0].astype({'Count':'Int64', 'Count_avg':'Int64'})
+
+    for p in pollutants:
+        #Saves csv with city data by pollutant
+        table_avg[p].rename_axis(columns=None).to_csv(dir_pcs_aqip+'MX_'+p+'_'+str(2017)+'-'+str(year_limit)+'.csv')
+
+    #Sets multiindex for stat_city
+    index = pd.MultiIndex.from_product([city, pollutants], names=['City','Specie'])
+
+    stat_city = stat_city.swaplevel().reindex(index)[['Count','Pctg','Count_avg','Pctg_avg']]
+    
+    #Saves csv with data ammount of dates with data for every city 
+    # and pollutant and a percentage of the total options available
+    stat_city.to_csv(dir_pcs_aqip+'MX_StatRes_'+str(2017)+'-'+str(year_limit)+'.csv')
+
+
+def write_parquet_store(data, city, pollutant, dir_store='../data/processed/parquet/', row_group_days=31):
+    """Function that writes a DataFrame with dates as rows and stations or cities as columns to a parquet store
+        partitioned by city, pollutant and year: <dir_store>/city=<city>/pollutant=<pollutant>/year=<year>/data.parquet.
+        Rows are sorted by date and written in row groups of row_group_days, so readers filtering by date only
+        read the row groups of the dates requested
+
+    Args:
+        data {DataFrame} -- DataFrame with a FECHA or Date column or index level and one column per station or city,
+                            rows of other pollutants in a PARAM or Specie column or index level are left out
+        city {str} -- code for the city, for example: cdmx
+        pollutant {str} -- chemical formula of the pollutant
+        dir_store {str} -- directory of the parquet store, set to data/processed/parquet/ by default
+        row_group_days {int} -- number of rows (days) per row group, set to 31 by default
+
+    Returns:
+        list -- paths of the parquet files written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    #dates and pollutants can be index levels, like the (PARAM, FECHA) index of the stack helpers
+    indexed = any(name in ('FECHA','Date','PARAM','Specie') for name in data.index.names)
+    data = data.reset_index() if indexed else data.copy()
+    data = data.rename(columns={'Date':'FECHA'})
+
+    #data with several pollutants is filtered to the one of the partition
+    for param in ('PARAM','Specie'):
+        if param in data.columns:
+            data = data[data[param].astype(str) == pollutant]
+
+    data = data.drop(columns=[c for c in ('index','PARAM','Specie','HORA') if c in data.columns])
+
+    data['FECHA'] = pd.to_datetime(data['FECHA'])
+    data = data.sort_values('FECHA')
+
+    files = []
+
+    for year, data_year in data.groupby(data['FECHA'].dt.year):
+
+        dir_part = dir_store+'city='+city+'/pollutant='+pollutant+'/year='+str(year)+'/'
+        os.makedirs(dir_part, exist_ok=True)
+
+        table = pa.Table.from_pandas(data_year, preserve_index=False)
+        pq.write_table(table, dir_part+'data.parquet', row_group_size=row_group_days)
+
+        files.append(dir_part+'data.parquet')
+
+    return (files)
+
+
+def to_parquet_store(csv_file, city, pollutant=None, dir_store='../data/processed/parquet/'):
+    """Function that converts a processed csv to the parquet store. Csv with a PARAM or Specie column
+        are written to one partition per pollutant
+
+    Args:
+        csv_file {str} -- path to processed csv, for example: data/processed/cdmx/cdmx_2017-2020_O3.csv
+        city {str} -- code for the city, for example: cdmx, or mx for AQIP data
+        pollutant {str} -- chemical formula of the pollutant, required when the csv has no PARAM or Specie column
+        dir_store {str} -- directory of the parquet store, set to data/processed/parquet/ by default
+
+    Returns:
+        list -- paths of the parquet files written
+    """
+    data = pd.read_csv(csv_file, encoding='latin_1')
+
+    param = 'PARAM' if 'PARAM' in data.columns else 'Specie' if 'Specie' in data.columns else None
+
+    if param is None:
+        return (write_parquet_store(data, city, pollutant, dir_store=dir_store))
+
+    files = []
+
+    for p, data_p in data.groupby(param):
+        files += write_parquet_store(data_p, city, p, dir_store=dir_store)
+
+    return (files)
+
+
+def read_parquet_store(city, pollutant, columns=None, start=None, end=None, dir_store='../data/processed/parquet/'):
+    """Function that reads data for a city and pollutant from the parquet store, only the year partitions
+        and row groups within start and end, and the columns requested, are read
+
+    Args:
+        city {str} -- code for the city, for example: cdmx
+        pollutant {str} -- chemical formula of the pollutant
+        columns {list} -- stations or cities to be read, all by default
+        start {str} -- first date to be read in format yyyy-mm-dd, set to None to read from the first date
+        end {str} -- last date to be read in format yyyy-mm-dd, set to None to read until the last date
+        dir_store {str} -- directory of the parquet store, set to data/processed/parquet/ by default
+
+    Returns:
+        DataFrame -- DataFrame indexed by FECHA as str in format yyyy-mm-dd with one column per station or city
+    """
+    import pyarrow.parquet as pq
+
+    dir_pol = dir_store+'city='+city+'/pollutant='+pollutant+'/'
+
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+
+    #filters pushed down to the row groups statistics
+    filters = []
+    if start is not None:
+        filters.append(('FECHA','>=',start))
+    if end is not None:
+        filters.append(('FECHA','<=',end))
+
+    data = []
+
+    for part in sorted(os.listdir(dir_pol)):
+
+        year = int(part.split('=')[1])
+
+        #skips years outside of the range
+        if (start is not None and year < start.year) or (end is not None and year > end.year):
+            continue
+
+        file = dir_pol+part+'/data.parquet'
+
+        cols = None
+        if columns is not None:
+            names = pq.read_schema(file).names
+            cols = ['FECHA']+[c for c in columns if c in names]
+
+        data.append(pq.read_table(file, columns=cols, filters=filters if len(filters) > 0 else None).to_pandas())
+
+    if len(data) == 0:
+        return (pd.DataFrame(columns=columns if columns is not None else []).rename_axis('FECHA'))
+
+    data = pd.concat(data, ignore_index=True, sort=False)
+
+    data['FECHA'] = data['FECHA'].dt.strftime('%Y-%m-%d') #same index as the processed csv
+
+    data = data.set_index('FECHA')
+
+    if columns is not None:
+        data = data.reindex(columns=columns)
+
+    return (data)
+
+
+class AQCube:
+    """Air quality data of a city as a float32 array of dates x stations x pollutants opened with np.memmap,
+        the array is shared through the page cache by every process that opens it
+
+    Args:
+        dir_cube {str} -- directory with cube.npy and cube_index.json written by build_aq_cube
+    """
+
+    def __init__(self, dir_cube):
+
+        with open (os.path.join(dir_cube,'cube_index.json'),'r') as aux:
+            index = json.load(aux)
+
+        self.dates = index['dates']
+        self.stations = index['stations']
+        self.pollutants = index['pollutants']
+
+        self._date = {d:i for i, d in enumerate(self.dates)}
+        self._station = {e:i for i, e in enumerate(self.stations)}
+        self._pollutant = {p:i for i, p in enumerate(self.pollutants)}
+
+        self.data = np.load(os.path.join(dir_cube,'cube.npy'), mmap_mode='r')
+
+    def date_slice(self, date, pollutant=None):
+        """Returns the values of every station for a date without copying them
+
+        Args:
+            date {str} -- date in format yyyy-mm-dd
+            pollutant {str} -- if specified, only the values of the pollutant are returned
+
+        Returns:
+            np.array -- array of stations x pollutants, or of stations when pollutant is specified
+        """
+        if pollutant is None:
+            return (self.data[self._date[date]])
+
+        return (self.data[self._date[date], :, self._pollutant[pollutant]])
+
+    def values(self, date, pollutant, stations):
+        """Returns the values of a list of stations for a date and pollutant
+
+        Args:
+            date {str} -- date in format yyyy-mm-dd
+            pollutant {str} -- chemical formula of the pollutant
+            stations {list} -- station codes, stations not in the cube are returned as nan
+
+        Returns:
+            np.array -- float array with a value per station
+        """
+        row = self.date_slice(date, pollutant)
+
+        idx = np.array([self._station.get(e, -1) for e in stations], dtype=int)
+
+        values = row[np.maximum(idx, 0)].astype(float)
+        values[idx < 0] = np.nan
+
+        return (values)
+
+
+def build_aq_cube(city, year_limit=2020, dir_cube=None):
+    """Function that writes the processed data of a city for every pollutant to a dates x stations x pollutants
+        float32 array in data/processed/<city>/cube/, with the dates, stations and pollutants in cube_index.json
+
+    Args:
+        city {str} -- code for the city, for example: cdmx
+        year_limit {int} -- int with the limit year for the city's database, set to 2020 by default
+        dir_cube {str} -- directory of the cube, set to data/processed/<city>/cube/ by default
+
+    Returns:
+        str -- directory of the cube
+    """
+    dir_pcs = '../data/processed/'
+
+    if dir_cube is None:
+        dir_cube = dir_pcs+city+'/cube/'
+
+    os.makedirs(dir_cube, exist_ok=True)
+
+    pollutants = [src.pollutant(i) for i in range(5)]
+
+    data = {}
+    for p in pollutants:
+        data_csv = dir_pcs+city+'/'+city+'_2017-'+str(year_limit)+'_'+p+'.csv'
+        if os.path.isfile(data_csv):
+            data[p] = pd.read_csv(data_csv).set_index('FECHA')
+
+    dates = sorted(set().union(*[d.index for d in data.values()]))
+
+    stations = []
+    for d in data.values():
+        stations += [e for e in d.columns if e not in stations]
+
+    #the array is written in date order so the stations of a date are contiguous on disk
+    cube = np.lib.format.open_memmap(os.path.join(dir_cube,'cube.npy'), mode='w+', dtype=np.float32,
+                                     shape=(len(dates), len(stations), len(pollutants)))
+    cube[:] = np.nan
+
+    for p, d in data.items():
+        cube[:, :, pollutants.index(p)] = d.reindex(index=dates, columns=stations).to_numpy(dtype=np.float32)
+
+    cube.flush()
+    del cube
+
+    with open (os.path.join(dir_cube,'cube_index.json'),'w') as outfile:
+        json.dump({'dates':dates, 'stations':stations, 'pollutants':pollutants}, outfile)
+
+    open_aq_cube.cache_clear() #cubes opened before are outdated
+
+    return (dir_cube)
+
+
+@lru_cache(maxsize=None)
+def open_aq_cube(city, dir_cube=None):
+    """Function that opens the cube of a city, each cube is opened only once per process
+
+    Args:
+        city {str} -- code for the city, for example: cdmx
+        dir_cube {str} -- directory of the cube, set to data/processed/<city>/cube/ by default
+
+    Returns:
+        AQCube -- cube with the data of the city
+    """
+    if dir_cube is None:
+        dir_cube = '../data/processed/'+city+'/cube/'
+
+    return (AQCube(dir_cube))
+
+
+#units of the concentrations from aqi_to_conc for every AQIP pollutant
+AQIP_UNITS = {'O3':'ppb', 'CO':'ppm', 'PM10':'ug/m3', 'PM25':'ug/m3', 'SO2':'ppb', 'NO2':'ppb'}
+
+
+class AQTable:
+    """Observations of every source in one long table with the columns source, city, station, pollutant,
+        timestamp, value and unit. Dimensions are stored as categories, so filters and joins compare integer codes
+        instead of strings, and rows are sorted by source, city, station, pollutant and timestamp
+
+    Args:
+        data {DataFrame} -- DataFrame with the columns of AQTable.COLUMNS
+    """
+
+    COLUMNS = ['source','city','station','pollutant','timestamp','value','unit']
+    DIMENSIONS = ['source','city','station','pollutant','unit']
+
+    def __init__(self, data):
+
+        data = data[self.COLUMNS].astype({**{col:'category' for col in self.DIMENSIONS}, 'value':np.float32})
+        data['timestamp'] = pd.to_datetime(data['timestamp'])
+
+        self.data = data.sort_values(['source','city','station','pollutant','timestamp']).reset_index(drop=True)
+
+    def __len__(self):
+        return (len(self.data))
+
+    @classmethod
+    def concat(cls, tables):
+        """Joins tables from different sources, categories are joined so codes are shared by every row
+
+        Args:
+            tables {list} -- list of AQTable
+
+        Returns:
+            AQTable -- table with the rows of every table
+        """
+        return (cls(pd.concat([table.data.astype({col:str for col in cls.DIMENSIONS}) for table in tables],
+                              ignore_index=True)))
+
+    def _mask(self, start=None, end=None, **filters):
+        #filters compare the codes of the categories, unknown values select no rows
+        mask = np.ones(len(self.data), dtype=bool)
+
+        for col, values in filters.items():
+            if values is None:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            codes = self.data[col].cat.categories.get_indexer(values)
+            mask &= np.isin(self.data[col].cat.codes.to_numpy(), codes[codes >= 0])
+
+        if start is not None:
+            mask &= (self.data['timestamp'] >= pd.Timestamp(start)).to_numpy()
+        if end is not None:
+            mask &= (self.data['timestamp'] <= pd.Timestamp(end)).to_numpy()
+
+        return (mask)
+
+    def select(self, start=None, end=None, **filters):
+        """Returns the rows of the table that match every filter
+
+        Args:
+            start {str} -- first timestamp, set to None by default
+            end {str} -- last timestamp, both included, set to None by default
+            filters -- value or list of values of source, city, station, pollutant or unit
+
+        Returns:
+            AQTable -- table with the rows selected
+        """
+        table = AQTable.__new__(AQTable)
+        table.data = self.data[self._mask(start, end, **filters)]
+
+        return (table)
+
+    def series(self, start=None, end=None, **filters):
+        """Returns the values of the rows that match every filter indexed by pollutant and timestamp, series of
+            different sources share the index so they are joined by index instead of merging columns
+
+        Args:
+            start {str} -- first timestamp, set to None by default
+            end {str} -- last timestamp, both included, set to None by default
+            filters -- value or list of values of source, city, station, pollutant or unit
+
+        Returns:
+            Series -- values indexed by pollutant and timestamp
+        """
+        data = self.data[self._mask(start, end, **filters)]
+
+        return (pd.Series(data['value'].to_numpy(),
+                          index=pd.MultiIndex.from_arrays([data['pollutant'], data['timestamp']],
+                                                          names=['pollutant','timestamp']), name='value'))
+
+    def pivot(self, index='timestamp', columns='station', freq=None, start=None, end=None, **filters):
+        """Pivot view of the rows that match every filter, for example dates x stations of a city and pollutant
+            like the processed csv, or dates x cities of a pollutant like aqip_mx
+
+        Args:
+            index {str or list} -- columns of the rows of the view, set to timestamp by default
+            columns {str or list} -- columns of the columns of the view, set to station by default
+            freq {str} -- if specified, timestamps are floored to freq and averaged, for example D, set to None by default
+            start {str} -- first timestamp, set to None by default
+            end {str} -- last timestamp, both included, set to None by default
+            filters -- value or list of values of source, city, station, pollutant or unit
+
+        Returns:
+            DataFrame -- DataFrame with the mean value of every combination of index and columns
+        """
+        data = self.data[self._mask(start, end, **filters)]
+
+        if freq is not None:
+            data = data.assign(timestamp=data['timestamp'].dt.floor(freq))
+
+        return (data.pivot_table(index=index, columns=columns, values='value', aggfunc='mean', observed=True))
+
+
+def stack_to_long(stack, source, city, units=None):
+    """Function that converts station data indexed by date and pollutant with a column per station, like the
+        stack csv of gdl_data and rama_data or the DataFrames of merge_aq and res_aqdata, to an AQTable
+
+    Args:
+        stack {DataFrame} -- DataFrame indexed by FECHA and PARAM, one column per station
+        source {str} -- name of the source, for example: SIMAJ or RAMA
+        city {str} -- city code, for example: gdl
+        units {dict} -- unit of every pollutant, set to None by default
+
+    Returns:
+        AQTable -- table with a row for every station, pollutant and date with data
+    """
+    data = stack.rename_axis(columns='station').stack().rename('value').reset_index()
+
+    data = data.rename(columns={'PARAM':'pollutant', 'FECHA':'timestamp'})
+    data['source'] = source
+    data['city'] = src.city_name(city)
+    data['unit'] = data['pollutant'].astype(str).map(units or {})
+
+    return (AQTable(data.dropna(subset=['value'])))
+
+
+def aqip_to_long(aqip, value='c_median'):
+    """Function that converts data from the Air Quality Index Project, like MX_2015 csv, to an AQTable,
+        the city is used as station
+
+    Args:
+        aqip {DataFrame} -- DataFrame with the columns City, Specie and Date, City can be the index
+        value {str} -- column with the concentration, set to c_median by default
+
+    Returns:
+        AQTable -- table with a row for every city, pollutant and date with data
+    """
+    data = aqip.reset_index() if 'City' in aqip.index.names else aqip
+
+    data = pd.DataFrame({'source':'AQIP', 'city':data['City'], 'station':data['City'], 'pollutant':data['Specie'],
+                         'timestamp':data['Date'], 'value':data[value],
+                         'unit':data['Specie'].astype(str).map(AQIP_UNITS)})
+
+    return (AQTable(data.dropna(subset=['value'])))
+
+
+def sinaica_to_long(mediciones, units=None):
+    """Function that converts SINAICA records, like the csv of ingest_json_dir, to an AQTable
+
+    Args:
+        mediciones {DataFrame} -- DataFrame with the columns of MEDICIONES_COLS
+        units {dict} -- unit of every pollutant, set to None by default
+
+    Returns:
+        AQTable -- table with a row for every station, pollutant and hour with data
+    """
+    timestamp = pd.to_datetime(mediciones['fecha'].astype(str).str[:10]) + \
+                pd.to_timedelta(pd.to_numeric(mediciones['hora'], errors='coerce').fillna(0), unit='h')
+
+    data = pd.DataFrame({'source':'SINAICA', 'city':mediciones['city'], 'station':mediciones['estacionesid'].astype(str),
+                         'pollutant':mediciones['parametro'], 'timestamp':timestamp,
+                         'value':pd.to_numeric(mediciones['valororig'], errors='coerce'),
+                         'unit':mediciones['parametro'].astype(str).map(units or {})})
+
+    return (AQTable(data.dropna(subset=['value'])))
+
+
+class _P2Median:
+    """Approximate median of a stream with the P-square algorithm (Jain and Chlamtac, 1985), keeps 5 markers
+        instead of the values
+    """
+
+    def __init__(self):
+
+        self.q = [] #heights of the markers, the first values until there are 5
+        self.n = [0, 1, 2, 3, 4] #positions of the markers
+        self.np = [0, 1, 2, 3, 4] #desired positions of the markers
+        self.dn = [0, 0.25, 0.5, 0.75, 1]
+
+    def update(self, values):
+
+        q, n = self.q, self.n
+
+        for x in values:
+
+            if len(q) < 5:
+                q.append(x)
+                if len(q) == 5:
+                    q.sort()
+                continue
+
+            #cell of the new value, extreme markers move with it
+            if x < q[0]:
+                q[0] = x
+                k = 0
+            elif x >= q[4]:
+                q[4] = x
+                k = 3
+            else:
+                k = 0
+                while x >= q[k+1]:
+                    k += 1
+
+            for i in range(k+1, 5):
+                n[i] += 1
+            for i in range(5):
+                self.np[i] += self.dn[i]
+
+            #adjusts the middle markers with a parabolic or a linear prediction
+            for i in range(1, 4):
+                d = self.np[i] - n[i]
+
+                if (d >= 1 and n[i+1]-n[i] > 1) or (d <= -1 and n[i-1]-n[i] < -1):
+                    d = 1 if d > 0 else -1
+
+                    qp = q[i] + d/(n[i+1]-n[i-1]) * ((n[i]-n[i-1]+d)*(q[i+1]-q[i])/(n[i+1]-n[i]) +
+                                                     (n[i+1]-n[i]-d)*(q[i]-q[i-1])/(n[i]-n[i-1]))
+
+                    if not q[i-1] < qp < q[i+1]:
+                        qp = q[i] + d*(q[i+d]-q[i])/(n[i+d]-n[i])
+
+                    q[i] = qp
+                    n[i] += d
+
+    def value(self):
+
+        if len(self.q) < 5:
+            return (float(np.median(self.q)) if len(self.q) > 0 else np.nan)
+
+        return (self.q[2])
+
+
+class DailyStats:
+    """Summary statistics by day of a stream of observations in a single pass: count, min, max, mean and variance
+        are combined chunk by chunk with the parallel form of Welford's algorithm, and the median is exact, keeping
+        the values of every day, or approximate with P-square, keeping 5 values by day
+
+    Args:
+        keys {list} -- columns grouped besides the day, set to ['city','pollutant'] by default, like AQIP
+        median {str} -- exact or p2, set to exact by default
+    """
+
+    def __init__(self, keys=('city','pollutant'), median='exact'):
+
+        if median not in ('exact','p2'):
+            raise ValueError('median must be exact or p2')
+
+        self.keys = list(keys)
+        self.median = median
+
+        self.stats = None #count, mean, m2, min and max by keys and day
+        self._median = {} #values or P-square markers by keys and day
+
+    def update(self, data):
+        """Adds a chunk of observations
+
+        Args:
+            data {AQTable or DataFrame} -- observations with the columns of keys, timestamp and value
+        """
+        data = data.data if isinstance(data, AQTable) else data
+
+        data = data.dropna(subset=['value'])
+        data = pd.DataFrame({**{k:data[k].astype(str) for k in self.keys},
+                             'day':pd.to_datetime(data['timestamp']).dt.normalize(),
+                             'value':data['value'].astype(np.float64)})
+
+        group = data.groupby(self.keys+['day'])['value']
+
+        chunk = group.agg(['count','mean','min','max'])
+        chunk['m2'] = group.var(ddof=0)*chunk['count']
+
+        if self.stats is None:
+            self.stats = chunk
+        else:
+            #combines the running statistics with the ones of the chunk
+            a, b = self.stats.align(chunk, join='outer')
+            a, b = a.fillna({'count':0, 'mean':0, 'm2':0}), b.fillna({'count':0, 'mean':0, 'm2':0})
+
+            count = a['count'] + b['count']
+            delta = b['mean'] - a['mean']
+
+            self.stats = pd.DataFrame({'count':count,
+                                       'mean':a['mean'] + delta*b['count']/count,
+                                       'min':np.fmin(a['min'], b['min']),
+                                       'max':np.fmax(a['max'], b['max']),
+                                       'm2':a['m2'] + b['m2'] + delta**2*a['count']*b['count']/count})
+
+        for key, values in group:
+            if self.median == 'exact':
+                self._median.setdefault(key, []).append(values.to_numpy())
+            else:
+                self._median.setdefault(key, _P2Median()).update(values.tolist())
+
+    def result(self):
+        """Returns the statistics with the columns of AQIP
+
+        Returns:
+            DataFrame -- DataFrame with Date, the keys and count, min, max, median, variance and mean,
+                         without rows when nothing was added
+        """
+        columns = ['Date']+[{'city':'City', 'pollutant':'Specie'}.get(k, k) for k in self.keys] + \
+                  ['count','min','max','median','variance','mean']
+
+        if self.stats is None:
+            return (pd.DataFrame(columns=columns).astype({'Date':'datetime64[ns]', 'count':int, 'min':np.float64,
+                                                          'max':np.float64, 'median':np.float64,
+                                                          'variance':np.float64, 'mean':np.float64}))
+
+        stats = self.stats.copy()
+
+        if self.median == 'exact':
+            stats['median'] = [np.median(np.concatenate(self._median[key])) for key in stats.index]
+        else:
+            stats['median'] = [self._median[key].value() for key in stats.index]
+
+        #sample variance, as pandas
+        stats['variance'] = (stats['m2']/(stats['count']-1)).where(stats['count'] > 1)
+
+        stats = stats.reset_index().rename(columns={'day':'Date', 'city':'City', 'pollutant':'Specie'})
+
+        return (stats[columns].astype({'count':int}))
+
+
+def aq_daily_stats(city, year_limit=2020, median='exact', chunksize=100000, keys=('city','pollutant'), save=True):
+    """Function that calculates count, min, max, median, variance and mean by day and pollutant of the stations
+        of a city in one pass over the csv written by merge_aq, with the columns of the AQIP database
+
+    Args:
+        city {str} -- city code to be analyzed
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        median {str} -- exact or p2 for an approximate median, set to exact by default
+        chunksize {int} -- number of rows read at a time, set to 100000 by default
+        keys {list} -- columns grouped besides the day, for example ['city','station','pollutant'], set to ['city','pollutant'] by default
+        save {bool} -- if False, the result is only returned and no csv is written, set to True by default
+
+    Returns:
+        csv -- csv with the statistics in data/processed/<city>/stats_2017-<year_limit>.csv
+        DataFrame -- DataFrame with the statistics
+    """
+    dir_pcs = '../data/processed/'+city+'/'
+
+    stats = DailyStats(keys, median)
+
+    for chunk in read_aq_csv(dir_pcs+city+'_'+str(2017)+'-'+str(year_limit)+'.csv', index_col=['PARAM','FECHA'],
+                             chunksize=chunksize):
+        stats.update(stack_to_long(chunk, 'stations', city))
+
+    stats = stats.result()
+
+    if save:
+        stats.to_csv(dir_pcs+'stats_'+str(2017)+'-'+str(year_limit)+'.csv', index=False)
+
+    return (stats)
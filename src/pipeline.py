@@ -0,0 +1,251 @@
+################################################################################
+# Module: Pipeline runner
+# Runs the processing stages of a city, skipping the stages whose inputs
+# and parameters did not change since their last run
+# updated: 16/10/2026
+################################################################################
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import src
+
+
+class Stage:
+    """Declaration of a processing stage: the function that runs it, its parameters and the files it reads and writes
+
+    Args:
+        name {str} -- unique name of the stage
+        func {function} -- module level function that runs the stage
+        params {dict} -- keyword arguments of func
+        inputs {list} -- paths of the files read by the stage
+        outputs {list} -- paths of the files written by the stage
+        deps {list} -- names of the stages that must run before, besides the ones writing an input
+    """
+
+    def __init__(self, name, func, params=None, inputs=(), outputs=(), deps=()):
+
+        self.name = name
+        self.func = func
+        self.params = params or {}
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+
+    def __repr__(self):
+        return ('Stage('+self.name+')')
+
+
+def city_stages(city, year_limit=2020, month_limit=5):
+    """Function that declares the stages for the air quality data of a city, from the yearly stacked
+        station data to the comparison with AQIP: merge_aq -> res_aqdata -> aq_daily_median -> aqip_city_mrg
+        -> data_valid, and merge_aq -> airquality_average
+
+    Args:
+        city {str} -- city code to be processed
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        month_limit {int} -- int with limit month to be analyzed, set to 5 (May) by default
+
+    Returns:
+        list -- list of Stage
+    """
+    dir_raw = '../data/raw/'
+    dir_pcs = '../data/processed/'
+
+    period = str(2017)+'-'+str(year_limit)
+
+    merged = dir_pcs+city+'/'+city+'_'+period+'.csv'
+
+    return ([Stage('merge_aq', src.merge_aq, {'city':city, 'year_limit':year_limit},
+                   inputs=[dir_raw+city+'/stack/'+str(year)+'.csv' for year in range(2017,year_limit+1)],
+                   outputs=[merged]),
+             Stage('res_aqdata', src.res_aqdata, {'city':city, 'year_limit':year_limit},
+                   inputs=[merged],
+                   outputs=[dir_pcs+city+'/res_'+period+'.csv']),
+             Stage('aq_daily_median', src.aq_daily_median, {'city':city, 'year_limit':year_limit},
+                   inputs=[dir_pcs+city+'/res_'+period+'.csv'],
+                   outputs=[dir_pcs+city+'/median_res_'+period+'.csv']),
+             Stage('aqip_city_mrg', src.aqip_city_mrg, {'city':city, 'year_limit':year_limit},
+                   inputs=[dir_pcs+city+'/median_res_'+period+'.csv', src.AQIP_MX_CSV],
+                   outputs=[dir_pcs+'aqip_'+city+'/'+city+'_AQIP.csv']),
+             Stage('data_valid', src.data_valid, {'city':city},
+                   inputs=[dir_pcs+'aqip_'+city+'/'+city+'_AQIP.csv']),
+             Stage('airquality_average', src.airquality_average,
+                   {'city':city, 'month_limit':month_limit, 'year_limit':year_limit},
+                   inputs=[merged],
+                   outputs=[merged[:-4]+'_'+src.pollutant(i)+'.csv' for i in range(5)])])
+
+
+def _input_hash(filename, hashes):
+    """Function that returns the sha256 of a file, reusing the hash saved in the previous run while the size and
+        modification time of the file are the same
+
+    Args:
+        filename {str} -- path to file
+        hashes {dict} -- hashes of the previous run by path, updated with the new hash
+
+    Returns:
+        str -- hex digest of the file contents, None if the file does not exist
+    """
+    if not os.path.isfile(filename):
+        hashes.pop(filename, None)
+        return (None)
+
+    stat = os.stat(filename)
+    saved = hashes.get(filename)
+
+    if saved is not None and saved['size'] == stat.st_size and saved['mtime'] == stat.st_mtime_ns:
+        return (saved['sha256'])
+
+    digest = src.data._file_hash(filename)
+    hashes[filename] = {'size':stat.st_size, 'mtime':stat.st_mtime_ns, 'sha256':digest}
+
+    return (digest)
+
+
+def _stage_key(stage, hashes, dep_keys):
+    """Function that returns the key of a stage run: its function, parameters, the hash of every input
+        and the keys of the dependencies that do not write one of its inputs
+
+    Args:
+        stage {Stage} -- stage to be run
+        hashes {dict} -- hashes of the previous run by path
+        dep_keys {dict} -- keys of the last run of the dependencies without a shared file
+
+    Returns:
+        str -- json with the key of the run
+    """
+    return (json.dumps({'func':stage.func.__module__+'.'+stage.func.__name__,
+                        'params':stage.params,
+                        'inputs':{i:_input_hash(i, hashes) for i in stage.inputs},
+                        'deps':dep_keys}, sort_keys=True, default=str))
+
+
+def _run_stage(func, params):
+    #stages communicate through their files, only small results like the one of data_valid are sent back
+    result = func(**params)
+
+    return (result if isinstance(result, (str, int, float)) else None)
+
+
+def run_pipeline(stages, state_file='../data/interim/pipeline.json', workers=4, force=False):
+    """Function that runs a list of stages in order of their dependencies. A stage is skipped when its function,
+        parameters and the contents of its inputs are the same as in its last run and its outputs exist.
+        Stages whose dependencies are done run in parallel in a process pool
+
+    Args:
+        stages {list} -- list of Stage, for example from city_stages
+        state_file {str} -- json file with the hashes and keys of the last run, set to ../data/interim/pipeline.json by default
+        workers {int} -- number of stages run at the same time, set to 4 by default
+        force {bool} -- if True, every stage is run, set to False by default
+
+    Returns:
+        dict -- dict with the name of every stage and its result, stages skipped return the result of their last run
+    """
+    if os.path.isfile(state_file):
+        with open (state_file) as aux:
+            state = json.load(aux)
+    else:
+        os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+        state = {'hashes':{}, 'stages':{}}
+
+    names = [stage.name for stage in stages]
+
+    #a stage depends on its declared stages and on the stages that write one of its inputs
+    writers = {output:stage.name for stage in stages for output in stage.outputs}
+    deps = {stage.name:set(d for d in stage.deps if d in names) |
+                       set(writers[i] for i in stage.inputs if i in writers and writers[i] != stage.name)
+            for stage in stages}
+
+    stage_by_name = dict(zip(names, stages))
+    pending = list(names)
+    running = {}
+    results = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+
+        while pending or running:
+
+            #stages whose dependencies are done, inputs are hashed once they exist
+            ready = [name for name in pending if not deps[name] & (set(pending) | set(n for n, _ in running.values()))]
+
+            for name in ready:
+                pending.remove(name)
+
+                stage = stage_by_name[name]
+                #changes of dependencies that share a file reach the stage through the hash of the file,
+                #the others through their key
+                linked = set(writers.get(i) for i in stage.inputs)
+                key = _stage_key(stage, state['hashes'], {d:state['stages'].get(d, {}).get('key')
+                                                          for d in sorted(deps[name] - linked)})
+                last = state['stages'].get(name, {})
+
+                if (not force and last.get('key') == key and all(os.path.isfile(o) for o in stage.outputs)):
+                    print('Skipping '+name)
+                    results[name] = last.get('result')
+                    continue
+
+                print('Running '+name)
+                running[pool.submit(_run_stage, stage.func, stage.params)] = (name, key)
+
+            if not running:
+                if pending and not ready:
+                    raise ValueError('stages with circular dependencies: '+', '.join(pending))
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name, key = running.pop(future)
+                result = future.result()
+
+                results[name] = result
+                state['stages'][name] = {'key':key, 'result':result}
+
+                src.data._write_state(state_file, state)
+
+    src.data._write_state(state_file, state)
+
+    return (results)
+
+
+def city_pipeline(city, year_limit=2020, month_limit=5, save=False, aqip=None):
+    """Function that runs the stages of city_stages in memory, every stage receives the DataFrame returned by the
+        previous one, so no intermediate csv is written or read. Only the yearly stacked station data and the
+        aqip csv are read, and when save is True the final results of aqip_city_mrg and airquality_average are saved
+
+    Args:
+        city {str} -- city code to be processed
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
+        month_limit {int} -- int with limit month to be analyzed, set to 5 (May) by default
+        save {bool} -- if True, the csv of aqip_city_mrg and airquality_average are written, set to False by default
+        aqip {DataFrame} -- data from aqip for mexican cities indexed by City, if None MX_2015 csv is read, set to None by default
+
+    Returns:
+        dict -- dict with the result of every stage and the seconds spent in each one under 'timings'
+    """
+    results = {}
+    timings = {}
+
+    def run(name, func, **params):
+        start = time.perf_counter()
+        results[name] = func(**params)
+        timings[name] = time.perf_counter() - start
+        return (results[name])
+
+    if aqip is None:
+        aqip = run('read_aqip', src.read_aq_csv, filename=src.AQIP_MX_CSV,
+                   index_col='City')
+
+    merged = run('merge_aq', src.merge_aq, city=city, year_limit=year_limit, save=False)
+    res = run('res_aqdata', src.res_aqdata, city=city, year_limit=year_limit, data=merged, save=False)
+    median = run('aq_daily_median', src.aq_daily_median, city=city, year_limit=year_limit, data=res, save=False)
+    compare = run('aqip_city_mrg', src.aqip_city_mrg, city=city, year_limit=year_limit, data=median, aqip=aqip, save=save)
+    run('data_valid', src.data_valid, city=city, data=compare)
+    run('airquality_average', src.airquality_average, city=city, month_limit=month_limit, year_limit=year_limit,
+        data=merged, save=save)
+
+    results['timings'] = timings
+
+    return (results)
@@ -16,8 +16,10 @@ from h3 import h3
 import shapely
 import logging
 import datetime as dt
+from functools import lru_cache
 from shapely.geometry import Point, Polygon
 from matplotlib.patches import RegularPolygon
+import src
 
 
 def find_nearest(G, gdf, amenity_name):
@@ -175,18 +177,34 @@ def pollutant(p):
 
     return (param[p])
 
-def city_valid_aqip(pollutant, tresh=0.75):
+def _aqip_stat_res(year_limit=2020):
+    #csv with statistics of data coverage from AQIP for mexican cities, read again only when aqip_mx rewrites it
+    filename = '../data/processed/aqip/MX_StatRes_2017-'+str(year_limit)+'.csv'
+    return (_read_aqip_stat_res(filename, os.stat(filename).st_mtime_ns))
+
+@lru_cache(maxsize=8)
+def _read_aqip_stat_res(filename, mtime):
+    #the modification time is part of the cache key
+    return (src.read_aq_csv(filename, encoding='latin_1', index_col='City'))
+
+def city_valid_aqip(pollutant, tresh=0.75, windows=None, year_limit=2020):
     """Function that aquieres list of cities that have equal or greater data coverage according to treshold value
 
     Args:
         pollutant {str} -- pollutant coverage to be analyzed
         tresh {float} -- treshold limit to be analyzed, set default to 0.75
+        windows {list} -- list of (start, end) tuples with the dates to be analyzed, if None
+                          the coverage from January to May calculated by aqip_mx is used
+        year_limit {int} -- int with limit year to be analyzed, set to 2020 by default
 
     Returns:
         list -- list with city names
     """
-    #Open csv with statistics of data coverage from AQIP for mexican cities
-    stat_mx = pd.read_csv('../data/processed/aqip/MX_StatRes_2017-2020.csv', encoding='latin_1').set_index('City')
+    if windows is not None:
+        #Coverage for any window from the index of days with data
+        return (src.aqip_coverage().valid(pollutant, windows, tresh))
+
+    stat_mx = _aqip_stat_res(year_limit)
 
     #Filters dataframe according to pollutant
     stat_mx = stat_mx[stat_mx['Specie']==pollutant]
@@ -213,6 +231,105 @@ def catch_outliers(pollutant):
     
     return (outlier[pollutant])
 
+class StationRegistry:
+    """Registry of air quality stations with their information stored as arrays and indexed by city and code,
+        positions returned by its methods are indexes of those arrays
+
+    Args:
+        stations {DataFrame} -- DataFrame with the columns codigo, lat, long, city and nombre
+    """
+
+    def __init__(self, stations):
+
+        self.codigo = stations['codigo'].to_numpy(dtype=object)
+        self.lat = stations['lat'].to_numpy(dtype=float)
+        self.long = stations['long'].to_numpy(dtype=float)
+        self.city = stations['city'].to_numpy(dtype=object)
+        self.nombre = stations['nombre'].to_numpy(dtype=object)
+
+        #positions of the stations of every city
+        self._by_city = {c:np.flatnonzero(self.city==c) for c in pd.unique(self.city)}
+
+        #codes are not unique across cities, so they are indexed together with the city
+        self._by_code = {}
+        for i, (c, code) in enumerate(zip(self.city, self.codigo)):
+            self._by_code.setdefault((c, code), i)
+            self._by_code.setdefault((None, code), i)
+
+    def __len__(self):
+        return (len(self.codigo))
+
+    def in_city(self, city):
+        """Returns the positions of the stations in a city
+
+        Args:
+            city {str} -- city name, for example: Valle de México
+
+        Returns:
+            np.array -- positions of the stations, empty if the city is not in the registry
+        """
+        return (self._by_city.get(city, np.array([], dtype=int)))
+
+    def lookup(self, codigo, city=None):
+        """Returns the position of a station
+
+        Args:
+            codigo {str} -- station code
+            city {str} -- city name, if not specified the first station with the code is returned
+
+        Returns:
+            int -- position of the station
+        """
+        return (self._by_code[(city, codigo)])
+
+    def within(self, min_x, min_y, max_x, max_y, city=None):
+        """Returns the positions of the stations inside a bounding box
+
+        Args:
+            min_x {float} -- minimum longitude
+            min_y {float} -- minimum latitude
+            max_x {float} -- maximum longitude
+            max_y {float} -- maximum latitude
+            city {str} -- if specified, only stations from the city are returned
+
+        Returns:
+            np.array -- positions of the stations
+        """
+        idx = np.arange(len(self)) if city is None else self.in_city(city)
+
+        mask = ((self.long[idx] >= min_x) & (self.long[idx] <= max_x) &
+                (self.lat[idx] >= min_y) & (self.lat[idx] <= max_y))
+
+        return (idx[mask])
+
+    def to_frame(self, idx=None):
+        """Returns the information of the stations as a DataFrame
+
+        Args:
+            idx {np.array} -- positions of the stations, all stations by default
+
+        Returns:
+            DataFrame -- DataFrame with the columns codigo, lat, long, city and nombre
+        """
+        if idx is None:
+            idx = np.arange(len(self))
+
+        return (pd.DataFrame({'codigo':self.codigo[idx], 'lat':self.lat[idx], 'long':self.long[idx],
+                              'city':self.city[idx], 'nombre':self.nombre[idx]}))
+
+
+@lru_cache(maxsize=None)
+def station_registry(stations_csv='../data/raw/Grl/stations/city_stations.csv'):
+    """Function that returns the station registry, the csv is read only once per process
+
+    Args:
+        stations_csv {str} -- csv with stations by city, set to data/raw/Grl/stations/city_stations.csv by default
+
+    Returns:
+        StationRegistry -- registry with the stations in the csv
+    """
+    return (StationRegistry(pd.read_csv(stations_csv)))
+
 def city_name(city):
     """Function that returns city name based city code
 
@@ -229,6 +346,104 @@ def city_name(city):
     
     return (city_dict[city])
 
+def aqip_city_name(city):
+    """Function that returns the name of a city in the Air Quality Index Project data based on city code
+
+    Args:
+        city {str} -- city code
+
+    Returns:
+        str -- city name in AQIP
+    """
+    #AQIP names the metropolitan area of cdmx after the city
+    city_dict = {'cdmx':'Mexico City',
+                'gdl':'Guadalajara',
+                'mty':'Monterrey'}
+
+    return (city_dict[city])
+
+#AQI breakpoints from: https://www.airnow.gov/sites/default/files/2020-05/aqi-technical-assistance-document-sept2018.pdf
+#for every pollutant: upper index of each segment, (index low, index high, concentration low, concentration high)
+#of each segment and a factor for the unit. Values outside the segments are converted to 0
+AQI_BREAKPOINTS = {
+    'O3':([50, 100, 150, 200, 300],
+          [(0,50,0,0.054), (51,100,0.055,0.070), (101,150,0.071,0.085), (151,200,0.086,0.105), (201,300,0.106,0.200)],
+          1000), #converts from ppm to ppb
+    'CO':([50, 100, 150, 200, 300, 400, np.inf],
+          [(0,50,0,4.4), (51,100,4.5,9.4), (101,150,9.5,12.4), (151,200,12.5,15.4), (201,300,15.5,30.4),
+           (301,400,30.5,40.4), (401,500,40.5,50.4)],
+          1),
+    'PM10':([50, 100, 150, 200, 300, 400, np.inf],
+            [(0,50,0,54), (51,100,55,154), (101,150,155,254), (151,200,255,354), (201,300,355,424),
+             (301,400,425,504), (401,500,505,604)],
+            1),
+    'PM25':([50, 100, 150, 200, 300, 400, np.inf],
+            [(0,50,0,12), (51,100,12.1,35.4), (101,150,35.5,55.4), (151,200,55.5,150.4), (201,300,150.5,250.4),
+             (301,400,250.5,350.4), (401,500,350.5,500.4)],
+            1.0),
+    'SO2':([50, 100, 150, 200, 300, 400, np.inf],
+           [(0,50,0,35), (51,100,36,75), (101,150,76,185), (151,200,186,304), (201,300,305,604),
+            (301,400,605,804), (401,500,805,1004)],
+           1),
+    'NO2':([50, 100, 150, 200, 300, 400, np.inf],
+           [(0,50,0,53), (51,100,54,100), (101,150,101,360), (151,200,361,649), (201,300,650,1249),
+            (301,400,1250,1649), (401,500,1650,2049)],
+           1.0),
+}
+
+def _aqi_segments(x, pollutant):
+    """Function that converts an array of air quality index values of a single pollutant to concentration
+
+    Args:
+        x {np.array} -- float array with air quality index values
+        pollutant {str} -- chemical formula of the pollutant
+
+    Returns:
+        np.array -- float array with concentrations
+    """
+    upper, segments, factor = AQI_BREAKPOINTS[pollutant]
+
+    segments = np.asarray(segments, dtype=float)
+
+    #segment of every value, values above the last segment and nan get len(upper)
+    seg = np.searchsorted(upper, x, side='left')
+    valid = seg < len(upper)
+
+    i_lo, i_hi, c_lo, c_hi = segments[np.minimum(seg, len(upper)-1)].T
+
+    with np.errstate(invalid='ignore'):
+        conc = np.where(valid, ((x-i_lo)*(c_hi-c_lo))/(i_hi-i_lo)+c_lo, 0)
+
+    return (conc*factor)
+
+def aqi_to_conc(aqi, pollutant):
+    """Function that calculates the concentration of pollutants based on air quality index for a whole array,
+        every value is converted once with the breakpoints of its pollutant in AQI_BREAKPOINTS
+
+    Args:
+        aqi {array} -- air quality index values
+        pollutant {str or array} -- chemical formula of the pollutant, or array with the pollutant of every value,
+                                    values of pollutants without breakpoints are converted to 0
+
+    Returns:
+        np.array -- float array with concentrations
+    """
+    x = np.asarray(aqi, dtype=float)
+
+    if isinstance(pollutant, str):
+        return (_aqi_segments(x, pollutant))
+
+    pollutant = np.asarray(pollutant)
+
+    conc = np.zeros(x.shape)
+
+    for p in AQI_BREAKPOINTS:
+        mask = pollutant == p
+        if mask.any():
+            conc[mask] = _aqi_segments(x[mask], p)
+
+    return (conc)
+
 def o3_conc(x):
     """Function that calculates the concentration of a pollutant based on air quality index based on 
         equations from: https://www.airnow.gov/sites/default/files/2020-05/aqi-technical-assistance-document-sept2018.pdf
@@ -239,19 +454,7 @@ def o3_conc(x):
     Returns:
         float -- concentration of the pollutant
     """
-    conc = 0
-    if x <= 50:
-        conc = ((x-0)*(0.054-0))/(50-0)+0
-    elif x>50 and x<=100:
-        conc = ((x-51)*(0.070-0.055))/(100-51)+0.055
-    elif x>100 and x<=150:
-        conc = ((x-101)*(0.085-0.071))/(150-101)+0.071
-    elif x>150 and x<=200:
-        conc = ((x-151)*(0.105-0.086))/(200-151)+0.086
-    elif x>200 and x<=300:
-        conc = ((x-201)*(0.200-0.106))/(300-201)+0.106
-        
-    return (conc*1000) #multiplies by 1000 to convert from ppm to ppb
+    return (float(aqi_to_conc(x, 'O3')))
 
 def co_conc(x):
     """Function that calculates the concentration of a pollutant based on air quality index based on 
@@ -263,24 +466,7 @@ def co_conc(x):
     Returns:
         float -- concentration of the pollutant
     """
-
-    conc = 0
-    if x <= 50:
-        conc = ((x-0)*(4.4-0))/(50-0)+0
-    elif x>50 and x<=100:
-        conc = ((x-51)*(9.4-4.5))/(100-51)+4.5
-    elif x>100 and x<=150:
-        conc = ((x-101)*(12.4-9.5))/(150-101)+9.5
-    elif x>150 and x<=200:
-        conc = ((x-151)*(15.4-12.5))/(200-151)+12.5
-    elif x>200 and x<=300:
-        conc = ((x-201)*(30.4-15.5))/(300-201)+15.5
-    elif x>300 and x<=400:
-        conc = ((x-301)*(40.4-30.5))/(400-301)+30.5
-    elif x>400:
-        conc = ((x-401)*(50.4-40.5))/(500-401)+40.5
-        
-    return (conc)
+    return (float(aqi_to_conc(x, 'CO')))
 
 def pm10_conc(x):
     """Function that calculates the concentration of a pollutant based on air quality index based on 
@@ -292,25 +478,8 @@ def pm10_conc(x):
     Returns:
         float -- concentration of the pollutant
     """
+    return (float(aqi_to_conc(x, 'PM10')))
 
-    conc = 0
-    if x <= 50:
-        conc = ((x-0)*(54-0))/(50-0)+0
-    elif x>50 and x<=100:
-        conc = ((x-51)*(154-55))/(100-51)+55
-    elif x>100 and x<=150:
-        conc = ((x-101)*(254-155))/(150-101)+155
-    elif x>150 and x<=200:
-        conc = ((x-151)*(354-255))/(200-151)+255
-    elif x>200 and x<=300:
-        conc = ((x-201)*(424-355))/(300-201)+355
-    elif x>300 and x<=400:
-        conc = ((x-301)*(504-425))/(400-301)+425
-    elif x>400:
-        conc = ((x-401)*(604-505))/(500-401)+505
-        
-    return (conc)
-        
 def pm25_conc(x):
     """Function that calculates the concentration of a pollutant based on air quality index based on 
         equations from: https://www.airnow.gov/sites/default/files/2020-05/aqi-technical-assistance-document-sept2018.pdf
@@ -321,24 +490,7 @@ def pm25_conc(x):
     Returns:
         float -- concentration of the pollutant
     """
-
-    conc = 0
-    if x <= 50:
-        conc = ((x-0)*(12-0))/(50-0)+0
-    elif x>50 and x<=100:
-        conc = ((x-51)*(35.4-12.1))/(100-51)+12.1
-    elif x>100 and x<=150:
-        conc = ((x-101)*(55.4-35.5))/(150-101)+35.5
-    elif x>150 and x<=200:
-        conc = ((x-151)*(150.4-55.5))/(200-151)+55.5
-    elif x>200 and x<=300:
-        conc = ((x-201)*(250.4-150.5))/(300-201)+150.5
-    elif x>300 and x<=400:
-        conc = ((x-301)*(350.4-250.5))/(400-301)+250.5
-    elif x>400:
-        conc = ((x-401)*(500.4-350.5))/(500-401)+350.5
-        
-    return (conc*1.0)
+    return (float(aqi_to_conc(x, 'PM25')))
 
 def so2_conc(x):
     """Function that calculates the concentration of a pollutant based on air quality index based on 
@@ -350,24 +502,7 @@ def so2_conc(x):
     Returns:
         float -- concentration of the pollutant
     """
-
-    conc = 0
-    if x <= 50:
-        conc = ((x-0)*(35-0))/(50-0)+0
-    elif x>50 and x<=100:
-        conc = ((x-51)*(75-36))/(100-51)+36
-    elif x>100 and x<=150:
-        conc = ((x-101)*(185-76))/(150-101)+76
-    elif x>150 and x<=200:
-        conc = ((x-151)*(304-186))/(200-151)+186
-    elif x>200 and x<=300:
-        conc = ((x-201)*(604-305))/(300-201)+305
-    elif x>300 and x<=400:
-        conc = ((x-301)*(804-605))/(400-301)+605
-    elif x>400:
-        conc = ((x-401)*(1004-805))/(500-401)+805 
-        
-    return (conc)
+    return (float(aqi_to_conc(x, 'SO2')))
 
 def no2_conc(x):
     """Function that calculates the concentration of a pollutant based on air quality index based on 
@@ -379,25 +514,7 @@ def no2_conc(x):
     Returns:
         float -- concentration of the pollutant
     """
-
-    conc = 0
-    if x <= 50:
-        conc = ((x-0)*(53-0))/(50-0)+0
-    elif x>50 and x<=100:
-        conc = ((x-51)*(100-54))/(100-51)+54
-    elif x>100 and x<=150:
-        conc = ((x-101)*(360-101))/(150-101)+101
-    elif x>150 and x<=200:
-        conc = ((x-151)*(649-361))/(200-151)+361
-    elif x>200 and x<=300:
-        conc = ((x-201)*(1249-650))/(300-201)+650
-    elif x>300 and x<=400:
-        conc = ((x-301)*(1649-1250))/(400-301)+1250
-    elif x>400:
-        conc = ((x-401)*(2049-1650))/(500-401)+1650
-        
-    return (conc*1.0)
-
+    return (float(aqi_to_conc(x, 'NO2')))
 
 def p_limits(pollutant):
 	"""Function that returns a limit value for a bad air quality
@@ -8,6 +8,7 @@
 import folium
 from datosgobmx import client
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from math import sqrt
@@ -41,32 +42,35 @@ def compare_aq(p, city, multiplier=1.0):
 
 
     dir_pcs = '../data/processed/'
-    dir_pcs_cat = dir_pcs+'aqip_'+city #Directory with merged data
+    dir_pcs_cat = dir_pcs+'aqip_'+city+'/' #Directory with merged data
     dir_fig_cmp = '../output/figures/aqip_analysis/' #Directory to save plot
+    os.makedirs(dir_fig_cmp, exist_ok=True)
+
+    compare = src.read_aq_csv(dir_pcs_cat +city+'_AQIP.csv') #merged csv from aqip_city_mrg
 
-    compare = pd.read_csv(dir_pcs_cat +city+'_AQIP.csv')
-    compare = compare.drop(columns=['count','min','max','median','variance','PARAM','FECHA']).rename(columns={'Specie':'Contaminante',
-                                                                                                                'Date':'Fecha'})
     ax = plt.gca()
-    compare[compare['Contaminante']==p].plot(kind='scatter', x='Fecha',y='cdmx_median', ax=ax)
+    compare[compare['Contaminante']==p].plot(kind='scatter', x='Fecha',y='mx_median', ax=ax)
     compare[compare['Contaminante']==p].plot(kind='scatter', x='Fecha',y='aqip_median', alpha = 0.75, ax=ax)
     
     plt.ylabel('Concentration: '+p)
     
-    plt.savefig(dir_fig_cmp+p+'_x'+str(multiplier)+'.png', dpi=100)
+    plt.savefig(dir_fig_cmp+city+'_'+p+'_x'+str(multiplier)+'.png', dpi=100)
     
     #plt.show()
 
-def visualize_stations():
+def visualize_stations(ttl=86400):
     """Function that creates folium map to visualize air quality stations in Mexico based on the SINAICA database,
         code based on: https://datos.gob.mx/blog/ventilando-datos-abiertos-sobre-calidad-del-aire
 
+    Args:
+        ttl {float} -- seconds a cached api response is reused, set to 86400 (one day) by default
+
     Returns:
         folium_map -- folium_map with information from all mexican air quality stations
     """
 
-    #calls datosgobmx and gets json with data from stations
-    parametros_request = client.makeCall('sinaica-estaciones',{'pageSize':200})
+    #calls datosgobmx through the response cache and gets json with data from stations
+    parametros_request = src.cached_call('sinaica-estaciones',{'pageSize':200}, ttl=ttl)
 
     stations = []
 
@@ -99,6 +103,85 @@ def visualize_stations():
     return folium_map
 
 
+#IMECA calculation based on: https://rama.edomex.gob.mx/imeca
+#CO, SO2 and NO2 are proportional to the concentration: (conc/divisor)*numerator/denominator
+IMECA_FACTORS = {'CO':(1, 100, 11), 'SO2':(1000, 100, 0.11), 'NO2':(1000, 100, 0.21)}
+
+#O3 and PM10 by segments: divisor of the concentration, upper concentration of each segment and
+#(slope, concentration subtracted, base) of the equation of each segment
+IMECA_SEGMENTS = {
+    'O3':(1000, [0.07, 0.095, 0.154, 0.204, 0.404, np.inf],
+          [(714.29,0,0), (2041.67,0.071,51), (844.83,0.096,101), (1000,0.155,151), (497.49,0.205,201), (1000,104,0)]),
+    'PM10':(1, [40, 75, 214, 354, 424, 504, np.inf],
+            [(1.25,0,0), (1.44,41,51), (0.355,76,101), (0.353,215,151), (1.4359,355,201), (1.253,425,301), (1,104,0)]),
+}
+
+#color of each IMECA category, the last one is used for values without IMECA
+IMECA_COLORS = ['#75b46f', '#f7ff55', '#ff9e4f', '#db3331', '#c158b8', '#ffffff']
+
+def imeca(param, conc):
+    """Function that calculates the IMECA of an array of concentrations of a pollutant,
+        IMECA calculation based on: https://rama.edomex.gob.mx/imeca
+
+    Args:
+        param {str} -- str with criteron pollutant chemical formula
+        conc {array} -- concentrations for the pollutant
+
+    Returns:
+        np.array -- float array with the IMECA, pollutants without equations get 0
+    """
+    conc = np.asarray(conc, dtype=float)
+
+    if param in IMECA_FACTORS:
+        divisor, numerator, denominator = IMECA_FACTORS[param]
+        return ((conc/divisor)*numerator/denominator)
+
+    if param not in IMECA_SEGMENTS:
+        return (np.zeros(conc.shape))
+
+    divisor, upper, segments = IMECA_SEGMENTS[param]
+
+    conc = conc/divisor
+    segments = np.asarray(segments, dtype=float)
+
+    #segment of every value, nan gets len(upper) and its IMECA is 0
+    seg = np.searchsorted(upper, conc, side='left')
+    valid = seg < len(upper)
+
+    slope, c_sub, base = segments[np.minimum(seg, len(upper)-1)].T
+
+    return (np.where(valid, slope*(conc-c_sub)+base, 0))
+
+def imeca_category(param, conc):
+    """Function that classifies an array of concentrations of a pollutant by IMECA
+
+    Args:
+        param {str} -- str with criteron pollutant chemical formula
+        conc {array} -- concentrations for the pollutant
+
+    Returns:
+        np.array -- int array with the position of the category in IMECA_COLORS
+    """
+    values = imeca(param, conc)
+
+    #categories up to 50, 100, 150, 200 and above 200
+    category = np.searchsorted([50, 100, 150, 200], values, side='left')
+    category[np.isnan(values)] = len(IMECA_COLORS)-1
+
+    return (category)
+
+def imeca_colors_array(param, conc):
+    """Function that returns the hex of the IMECA category of an array of concentrations of a pollutant
+
+    Args:
+        param {str} -- str with criteron pollutant chemical formula
+        conc {array} -- concentrations for the pollutant
+
+    Returns:
+        np.array -- array with the hex codes
+    """
+    return (np.array(IMECA_COLORS, dtype=object)[imeca_category(param, conc)])
+
 def imeca_colors (param, conc):
     """Function that takes a pollutant and concentration, calculates its IMECA and returns a hex,
         IMECA calculation based on: https://rama.edomex.gob.mx/imeca
@@ -110,87 +193,9 @@ def imeca_colors (param, conc):
     Returns:
         str -- sr with the hex code
     """
-    
-    imeca = 0
-    
-    if param == 'CO':
-    
-        imeca = conc * 100 / 11
-        
-    elif param == 'SO2':
-    
-        imeca = (conc/1000) * 100 / 0.11
-        
-    elif param == 'NO2':
-    
-        imeca = (conc/1000) * 100 / 0.21
-        
-    elif param == 'O3':
-        
-        conc = conc/1000
-        
-        if conc <= 0.07:
-            imeca = 714.29*conc
-        
-        elif 0.07 < conc <= 0.095:
-            imeca = 2041.67*(conc-0.071)+51
-            
-        elif 0.095 < conc <= 0.154:
-            imeca = 844.83*(conc-0.096)+101
-            
-        elif 0.154 < conc <= 0.204:
-            imeca = 1000*(conc-0.155)+151
-            
-        elif 0.204 < conc <= 0.404:
-            imeca = 497.49*(conc-0.205)+201
-        
-        elif 0.404 < conc:
-            imeca = 1000*(conc-104)
-            
-    elif param == 'PM10':
-        
-        if conc <= 40:
-            imeca = 1.25*conc
-        
-        elif 40 < conc <= 75:
-            imeca = 1.44*(conc-41)+51
-            
-        elif 75 < conc <= 214:
-            imeca = 0.355*(conc-76)+101
-            
-        elif 214 < conc <= 354:
-            imeca = 0.353*(conc-215)+151
-            
-        elif 354 < conc <= 424:
-            imeca = 1.4359*(conc-355)+201
-        
-        elif 424 < conc <= 504:
-            imeca = 1.253*(conc-425)+301
-            
-        elif 504 < conc:
-            imeca = conc-104
-            
-    if imeca <= 50:
-        color = '#75b46f'
-        
-    elif 50 < imeca <= 100:
-        color = '#f7ff55'
-        
-    elif 100 < imeca <= 150:
-        color = '#ff9e4f'
-        
-    elif 150  < imeca <= 200:
-        color = '#db3331'
-    
-    elif 200 < imeca:
-        color = '#c158b8'
-        
-    else:
-        color = '#ffffff'
-        
-    return (color)
+    return (imeca_colors_array(param, [conc])[0])
 
-def visualize_aqdata_date(city, pollutant, date, year_limit=2020, zoom=10):
+def visualize_aqdata_date(city, pollutant, date, year_limit=2020, zoom=10, dir_store=None, cube=None):
     """ Creates a folium map with stations arranged by size and colour depending on the concentration of the pollutant
 
     Args:
@@ -199,32 +204,40 @@ def visualize_aqdata_date(city, pollutant, date, year_limit=2020, zoom=10):
         date {str} -- date to be analysed in format yyyy-mm-dd
         year_limit{int} -- int with the limit year for the city's database, set to 2020 by default
         zoom{int} -- zoom start value for the folium_map, set to 10 by default
+        dir_store {str} -- if specified, the date is read from the parquet store in this directory
+                           instead of the processed csv, set to None by default
+        cube {AQCube} -- if specified, the date is read from the cube of the city instead of the processed csv,
+                         set to None by default
 
     Returns:
         folium map
     """
     dir_pcs = '../data/processed/'
 
-    city_stations = pd.read_csv('../data/raw/Grl/stations/city_stations.csv') #csv with stations by city
+    stations = src.station_registry() #registry with stations by city
 
-    data_csv = dir_pcs+city+'/'+city+'_2017-'+str(year_limit)+'_'+pollutant+'.csv'
-    
-    data_bydateParam = pd.read_csv(data_csv).set_index('FECHA')
-    
-    #lists to append valid values of lat and long to set the center
-    
-    x = []
-    y = []
+    est = stations.in_city(src.city_name(city)) #positions of the city's stations in the registry
+
+    #concentration of every station for the date
+    if cube is not None:
+        c_values = cube.values(date, pollutant, stations.codigo[est])
+
+    else:
+        if dir_store is not None:
+            #reads only the row group with the date
+            data_bydateParam = src.read_parquet_store(city, pollutant, start=date, end=date, dir_store=dir_store)
+
+        else:
+            data_csv = dir_pcs+city+'/'+city+'_2017-'+str(year_limit)+'_'+pollutant+'.csv'
     
-    for i,est in city_stations[city_stations['city']==src.city_name(city)].iterrows():
+            data_bydateParam = pd.read_csv(data_csv).set_index('FECHA')
 
-                est_code = city_stations.loc[(i),'codigo']
-                c_value = data_bydateParam.loc[(date),est_code]
-                
-                #saves coordinates of stations with data
-                if pd.notna(c_value):
-                    x.append(est.long)
-                    y.append(est.lat)
+        c_values = data_bydateParam.loc[(date),stations.codigo[est]].to_numpy(dtype=float)
+
+    #saves coordinates of stations with data
+    valid = ~np.isnan(c_values)
+    x = stations.long[est][valid]
+    y = stations.lat[est][valid]
 
     #Registers the boundries coordinates to set a center
     min_x = min(x)
@@ -239,20 +252,17 @@ def visualize_aqdata_date(city, pollutant, date, year_limit=2020, zoom=10):
     folium_map = folium.Map(location=[centro_lat,centro_lon], zoom_start=zoom,
                             tiles = 'cartodb positron')
 
-    for i, est in city_stations[city_stations['city']==src.city_name(city)].iterrows():
-
-        est_code = city_stations.loc[(i),'codigo']
+    c_graphs = c_values/src.p_limits(pollutant)
+    colors = imeca_colors_array(pollutant, c_graphs)
 
-        #Coloca los marcadores en el mapa
-        c_value = data_bydateParam.loc[(date),est_code]
-        c_graph = (data_bydateParam.loc[(date),est_code])/src.p_limits(pollutant)
+    for i, c_value, c_graph, color in zip(est, c_values, c_graphs, colors):
 
         #Puntos con nombre, latitud y longitud
-        popup_text = f"<b> Nombre: </b> {est.nombre} <br> <b> Latitud: </b> {est.lat:.5f} <br> <b> Longitud: </b> {est.long:.5f} <br> <b> Contaminante: </b> {pollutant} <br> <b> Conc: </b> {c_value} <br>"
+        popup_text = f"<b> Nombre: </b> {stations.nombre[i]} <br> <b> Latitud: </b> {stations.lat[i]:.5f} <br> <b> Longitud: </b> {stations.long[i]:.5f} <br> <b> Contaminante: </b> {pollutant} <br> <b> Conc: </b> {c_value} <br>"
 
         #Coloca los marcadores en el mapa
-        folium.CircleMarker(location=[est.lat, est.long], radius=c_graph*50,
-                            tooltip = popup_text, fill=True, color=imeca_colors(pollutant, c_graph),
+        folium.CircleMarker(location=[stations.lat[i], stations.long[i]], radius=c_graph*50,
+                            tooltip = popup_text, fill=True, color=color,
                             fill_opacity=0.65).add_to(folium_map)
 
     return(folium_map)
@@ -274,7 +284,7 @@ def clr_change(conc_cmp):
         
     return color
 
-def compare_year_prior(city, pollutant, date, year_limit=2020, zoom=10):
+def compare_year_prior(city, pollutant, date, year_limit=2020, zoom=10, cube=None):
     """Creates a map with the analysis of the average between the week previous to the input date 
         and the weeek of the previous year for a selected pollutant
 
@@ -284,35 +294,38 @@ def compare_year_prior(city, pollutant, date, year_limit=2020, zoom=10):
         date {str} -- date to be analyzed in format yyyy-mm-dd
         year_limit{int} -- int with the limit year for the city's database, set to 2020 by default
         zoom{int} -- zoom start value for the folium_map
+        cube {AQCube} -- if specified, the dates are read from the cube of the city instead of the processed csv,
+                         set to None by default
 
     Returns:
         folium_map -- folium map where a blue marker indicates a smaller value of the input date concentration and, 
                         the bigger the marker the larger the concentration
     """
-    city_stations = pd.read_csv('../data/raw/Grl/stations/city_stations.csv') #csv with stations by city
+    stations = src.station_registry() #registry with stations by city
 
     dir_pcs = '../data/processed/'
     
     prev_year = str(int(date[:4])-1)+date[4:]
     
-    data_csv = dir_pcs+city+'/'+city+'_2017-'+str(year_limit)+'_'+pollutant+'.csv'
-    
-    data_bydateParam = pd.read_csv(data_csv).set_index('FECHA')
-    
-    #lists to append valid values of lat and long to set the center
-    
-    x = []
-    y = []
+    est = stations.in_city(src.city_name(city)) #positions of the city's stations in the registry
+
+    #concentrations of every station for the date and the same date of the previous year
+    if cube is not None:
+        c_current = cube.values(date, pollutant, stations.codigo[est])
+        c_prev = cube.values(prev_year, pollutant, stations.codigo[est])
+
+    else:
+        data_csv = dir_pcs+city+'/'+city+'_2017-'+str(year_limit)+'_'+pollutant+'.csv'
     
-    for i, est in city_stations[city_stations['city']==src.city_name(city)].iterrows():
+        data_bydateParam = pd.read_csv(data_csv).set_index('FECHA')
 
-                est_code = city_stations.loc[(i),'codigo']
-                c_value = data_bydateParam.loc[(date),est_code]
-                
-                #saves coordinates of stations with data
-                if pd.notna(c_value):
-                    x.append(est.long)
-                    y.append(est.lat)
+        c_current = data_bydateParam.loc[(date),stations.codigo[est]].to_numpy(dtype=float)
+        c_prev = data_bydateParam.loc[(prev_year),stations.codigo[est]].to_numpy(dtype=float)
+
+    #saves coordinates of stations with data
+    valid = ~np.isnan(c_current)
+    x = stations.long[est][valid]
+    y = stations.lat[est][valid]
 
    #Registers the boundries coordinates to set a center
     min_x = min(x)
@@ -330,20 +343,15 @@ def compare_year_prior(city, pollutant, date, year_limit=2020, zoom=10):
     folium_map = folium.Map(location=[centro_lat,centro_lon], zoom_start=zoom,
                             tiles = 'cartodb positron')
 
-    for i, est in city_stations[city_stations['city']==src.city_name(city)].iterrows():
-
-        est_code = city_stations.loc[(i),'codigo']
+    c_graphs = (c_current - c_prev)/c_prev
 
-        #Coloca los marcadores en el mapa
-        c_current = data_bydateParam.loc[(date),est_code]
-        c_prev = data_bydateParam.loc[(prev_year),est_code]
-        c_graph = (c_current - c_prev)/c_prev
+    for i, c_graph in zip(est, c_graphs):
 
         #Puntos con nombre, latitud y longitud
-        popup_text = f"<b> Nombre: </b> {est.nombre} <br> <b> Latitud: </b> {est.lat:.5f} <br> <b> Longitud: </b> {est.long:.5f} <br> <b> Contaminante: </b> {pollutant} <br> <b> Conc: </b> {c_graph} <br>"
+        popup_text = f"<b> Nombre: </b> {stations.nombre[i]} <br> <b> Latitud: </b> {stations.lat[i]:.5f} <br> <b> Longitud: </b> {stations.long[i]:.5f} <br> <b> Contaminante: </b> {pollutant} <br> <b> Conc: </b> {c_graph} <br>"
 
         #Coloca los marcadores en el mapa
-        folium.CircleMarker(location=[est.lat, est.long], radius=abs(c_graph)*50,
+        folium.CircleMarker(location=[stations.lat[i], stations.long[i]], radius=abs(c_graph)*50,
                             tooltip = popup_text, fill=True, color=clr_change(c_graph),
                             fill_opacity=0.65).add_to(folium_map)
 
@@ -366,27 +374,21 @@ def interpolate_aqdata_date(city, pollutant, date, year_limit=2020, cellsize=0.0
 
     dir_pcs = '../data/processed/'
 
-    city_stations = pd.read_csv('../data/raw/Grl/stations/city_stations.csv') #csv with stations by city
-
+    stations = src.station_registry() #registry with stations by city
 
     data_csv = dir_pcs+city+'/'+city+'_2017-'+str(year_limit)+'_'+pollutant+'.csv'
     
     data_bydateParam = pd.read_csv(data_csv).set_index('FECHA')
     
-    #lists to append valid values of lat and long for interpolation
-    
-    x = []
-    y = []
-    
-    for i, est in city_stations[city_stations['city']==src.city_name(city)].iterrows():
+    est = stations.in_city(src.city_name(city)) #positions of the city's stations in the registry
 
-                est_code = city_stations.loc[(i),'codigo']
-                c_value = data_bydateParam.loc[(date),est_code]
-                
-                #saves coordinates of stations with air quality data
-                if pd.notna(c_value):
-                    x.append(est.long)
-                    y.append(est.lat)
+    c_values = data_bydateParam.loc[(date),stations.codigo[est]].to_numpy(dtype=float)
+
+    #saves coordinates and values of stations with air quality data
+    valid = ~np.isnan(c_values)
+    x = stations.long[est][valid]
+    y = stations.lat[est][valid]
+    c_values = c_values[valid]
 
     #Registers the boundries coordinates for the interpolation
     min_x = min(x)
@@ -412,14 +414,9 @@ def interpolate_aqdata_date(city, pollutant, date, year_limit=2020, cellsize=0.0
 
     while xidw <= max_x:
         while yidw <= max_y:
-            for i, est in city_stations[city_stations['city']==src.city_name(city)].iterrows():
-
-                est_code = city_stations.loc[(i),'codigo']
-                c_value = data_bydateParam.loc[(date),est_code]
-
-                if pd.notna(c_value):
-                    dividendo = (c_value/(sqrt((est.long-xidw)**2+(est.lat-yidw)**2)**(p)))+ dividendo
-                    divisor = (1/(sqrt((est.long-xidw)**2+(est.lat-yidw)**2)**(p))) + divisor
+            dist = np.sqrt((x-xidw)**2+(y-yidw)**2)**(p)
+            dividendo = (c_values/dist).sum()
+            divisor = (1/dist).sum()
 
             concentracion = dividendo/divisor
             #Aqui se guardan los valores de las concentraciones para usarlos despues
@@ -584,11 +581,9 @@ def aqip_yearly(month_limit=5, year_limit=2020):
     
     for i in range(5):
         
-        aqip_mx = pd.read_csv(dir_pcs+'MX_'+src.pollutant(i)+'_'+str(2017)+'-'+str(year_limit)+'_raw.csv',
+        aqip_mx = src.read_aq_csv(dir_pcs+'MX_'+src.pollutant(i)+'_'+str(2017)+'-'+str(year_limit)+'_raw.csv',
                  encoding='latin_1') #DataFrame with air quality concentrations by week and city
         
-        aqip_mx['Date'] = pd.to_datetime(aqip_mx['Date'])
-        
         cty_aqip = src.city_valid_aqip(src.pollutant(i)) #creates a list with cities above treshold
         
         outlier = src.catch_outliers(src.pollutant(i)) #outlier limit
@@ -631,7 +626,7 @@ def hex_plot(pollutant, city, station, ax, gdf_data, gdf_boundary, column , titl
     Arguments:
         pollutant {str} -- pollutant to be plotted
         city {str} -- code for the city to be analyzed, for example: cdmx
-        station {gdf} -- gdf with stations within the city
+        station {gdf} -- gdf with stations within the city, if None the shared station registry is used
         ax {matplotlib.axes} -- ax to use in the plot
         gdf_data {geopandas.GeoDataFrame} -- geoDataFrame with the data to be plotted
         gdf_boundary {geopandas.GeoDataFrame} -- geoDataFrame with the boundary to use 
@@ -650,7 +645,7 @@ def hex_plot(pollutant, city, station, ax, gdf_data, gdf_boundary, column , titl
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("bottom", size="5%", pad=0.1)
     gdf_data[gdf_data[column]<=0].plot(ax=ax,color='#2b2b2b', alpha=0.95, linewidth=0.1, edgecolor='k', zorder=0)
-    gdf_data['color'] = gdf_data[column].apply(lambda c :imeca_colors(pollutant,c))
+    gdf_data['color'] = imeca_colors_array(pollutant, gdf_data[column].to_numpy())
     gdf_data[gdf_data[column]>0].plot(ax=ax,column=column, cmap='viridis',vmin=0, vmax=src.p_limits(pollutant),
                                       zorder=1,legend=True,cax=cax,legend_kwds={'label':'Concentración'+src.p_unit(pollutant),'orientation': "horizontal"})
     
@@ -658,9 +653,16 @@ def hex_plot(pollutant, city, station, ax, gdf_data, gdf_boundary, column , titl
     gdf_boundary.boundary.plot(ax=ax,color='#f8f8f8',zorder=2,linestyle='--',linewidth=0.5)
     
     
+    #stations within the city, taken from the shared station registry when no stations are passed
+    if station is None:
+        registry = src.station_registry()
+        station_city = registry.to_frame(registry.in_city(src.city_name(city)))
+
+    else:
+        station_city = station[station['city']==src.city_name(city)]
+
     station_gdf = gpd.GeoDataFrame(
-        station[station['city']==src.city_name(city)], geometry=gpd.points_from_xy(station[station['city']==src.city_name(city)].long, 
-                                                                                         station[station['city']==src.city_name(city)].lat))
+        station_city, geometry=gpd.points_from_xy(station_city.long, station_city.lat))
     
     station_gdf.crs = {'init':' epsg:4326'}
     